@@ -1,29 +1,80 @@
 import os
+import sys
+import csv
+import io
 import json
+import pstats
+import cProfile
+import re
+import gzip
+import heapq
 import random
 import sqlite3
+import shutil
+import time
 import asyncio
+import threading
+import traceback
 import logging
+import argparse
+import difflib
+import itertools
+import operator
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from pathlib import Path
+from collections import Counter, OrderedDict, deque
 from typing import Dict, Any, List, Optional
 
-from aiogram import Bot, Dispatcher
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import (Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
+                           InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BufferedInputFile)
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
 
 # ====== CONFIG ======
 TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
+# офлайн-команды (python main.py import/export ...) работают без токена
+CLI_MODE = __name__ == "__main__" and len(sys.argv) > 1
+if not TOKEN and not CLI_MODE:
     raise SystemExit("Установите BOT_TOKEN в окружении.")
 
+# локальный Bot API (например, python main.py fakeapi) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
 DB_PATH = "dnd.db"
 LOG_FILE = "bot.log"
 ADMIN_ID = 478122255  # change if needed
 
 START_GOLD = 30
+ALLOC_POINTS = 10  # очков атрибутов при создании персонажа
+SESSION_TTL = 15 * 60  # незавершённые сессии (создание, экипировка, GM-меню) сбрасываются через 15 минут
+HP_REGEN_INTERVAL = int(os.getenv("HP_REGEN_INTERVAL", "0"))  # сек, 0 — регенерация выключена
+HP_REGEN_AMOUNT = int(os.getenv("HP_REGEN_AMOUNT", "1"))
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "0.5"))  # нажатий в секунду на одно действие в группе
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "3"))     # сколько нажатий подряд допускается сразу
+PROFILE_MODE = os.getenv("PROFILE_MODE", "off")  # off | slow (апдейты дольше PROFILE_SLOW_MS) | sample
+PROFILE_SLOW_MS = int(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+MAINT_INTERVAL = int(os.getenv("MAINT_INTERVAL", "3600"))  # сек между обслуживаниями БД, 0 — только /maintenance
+NPC_ARCHIVE_DAYS = int(os.getenv("NPC_ARCHIVE_DAYS", "30"))  # сколько хранить погибших мобов в npc_archive
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", str(6 * 3600)))  # сек между горячими копиями, 0 — только /backup
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "10"))  # сколько последних копий хранить
+LAG_THRESHOLD_MS = int(os.getenv("LAG_THRESHOLD_MS", "250"))  # остановка event loop дольше — в лог со стеком, 0 — без сторожа
+USER_QUEUE_LIMIT = 5  # сколько апдейтов одного пользователя может ждать своей очереди, лишние отбрасываются
+CHECK_DC = 15  # испытание считается пройденным (для статистики), если итог d20 >= CHECK_DC
 
 ATTRIBUTES = ["сила", "ловкость", "интеллект", "внимание", "скрытность", "харизма"]
+CLASSES = ["воин", "вор", "волшебник", "лучник"]
+# колонки атрибутов в characters/npc и бонусов в items, в порядке ATTRIBUTES
+ATTR_COLUMNS = ["strength", "agility", "intellect", "perception", "stealth", "charisma"]
+ATTR_SQL = ", ".join(ATTR_COLUMNS)
 
 # Race bonuses (updated attribute names)
 RACE_BONUSES = {
@@ -56,11 +107,48 @@ def conn():
 def zero_bonus():
     return {a: 0 for a in ATTRIBUTES}
 
+def attrs_from_row(values) -> Dict[str, int]:
+    # values — срез строки с колонками ATTR_COLUMNS
+    return dict(zip(ATTRIBUTES, values))
+
+def attrs_to_row(attrs: Dict[str, int]) -> tuple:
+    return tuple(int(attrs.get(a, 0) or 0) for a in ATTRIBUTES)
+
 def init_db():
-    db_path = Path(DB_PATH).resolve()
-    logger.info("Init DB at: %s", db_path)
+    """
+    Приводит схему БД к актуальной версии (PRAGMA user_version).
+    На уже обновлённой базе это одна проверка версии.
+    """
     c = conn()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        c.close()
+        return
+    logger.info("Init DB at: %s (schema v%s -> v%s)", Path(DB_PATH).resolve(), version, len(MIGRATIONS))
+    c.isolation_level = None  # manual transactions: DDL + user_version commit together
     cur = c.cursor()
+    try:
+        for step, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Applying migration %s: %s", step, migration.__name__)
+            cur.execute("BEGIN")
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {step}")
+            cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        c.close()
+    # migrate_characters_defaults()
+
+def _table_columns(cur, table: str) -> List[str]:
+    return [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def _add_column_if_missing(cur, table: str, column: str, decl: str):
+    if column not in _table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def migration_base_schema(cur):
     # stores table
     cur.execute("""
     CREATE TABLE IF NOT EXISTS stores (
@@ -110,15 +198,169 @@ def init_db():
             in_combat INTEGER NOT NULL DEFAULT 0
         )
         """)
-    c.commit()
-    c.close()
-    seed_stores_and_items_if_empty()
-    ensure_flags_table()
-    # migrate_characters_defaults()
+    # flags table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS flags (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+    # seed default if not exists
+    cur.execute("INSERT OR IGNORE INTO flags (name, value) VALUES ('shop_enabled', 1)")
+    seed_stores_and_items_if_empty(cur)
+
+def migration_fix_drift(cur):
+    # старые базы создавались до появления этих колонок (create_npc пишет npc.damage)
+    _add_column_if_missing(cur, "npc", "damage", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cur, "items", "armor", "INTEGER DEFAULT 0")
+    _add_column_if_missing(cur, "characters", "armor_id", "INTEGER")
+
+def migration_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_npc_in_combat ON npc(in_combat)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_items_store_hidden ON items(store_id, hidden)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_items_name ON items(name)")
+
+def _search_norm_sql(col: str) -> str:
+    # unicode61 сам приводит регистр кириллицы, но "ё" для него отдельная буква
+    return f"replace(replace({col}, 'ё', 'е'), 'Ё', 'Е')"
+
+def migration_search_index(cur):
+    # rowid: items -> id*2, characters -> user_id*2+1, чтобы триггеры удаляли по rowid без скана.
+    # INSERT OR REPLACE в characters не вызывает DELETE-триггер, поэтому вставка тоже OR REPLACE.
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            name, kind UNINDEXED, ref_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_vocab USING fts5vocab(search_index, row)")
+    for table, key, name_col, kind, rowid in (("items", "id", "name", "item", "{}.id * 2"),
+                                               ("characters", "user_id", "username", "character", "{}.user_id * 2 + 1")):
+        new_rowid, old_rowid = rowid.format("new"), rowid.format("old")
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_ai AFTER INSERT ON {table} BEGIN
+                INSERT OR REPLACE INTO search_index (rowid, name, kind, ref_id)
+                VALUES ({new_rowid}, {_search_norm_sql(f"coalesce(new.{name_col}, '')")}, '{kind}', new.{key});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_ad AFTER DELETE ON {table} BEGIN
+                DELETE FROM search_index WHERE rowid = {old_rowid};
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_au AFTER UPDATE OF {key}, {name_col} ON {table} BEGIN
+                DELETE FROM search_index WHERE rowid = {old_rowid};
+                INSERT INTO search_index (rowid, name, kind, ref_id)
+                VALUES ({new_rowid}, {_search_norm_sql(f"coalesce(new.{name_col}, '')")}, '{kind}', new.{key});
+            END
+        """)
+        cur.execute(f"""
+            INSERT INTO search_index (rowid, name, kind, ref_id)
+            SELECT {rowid.format(table)}, {_search_norm_sql(f"coalesce({name_col}, '')")}, '{kind}', {key} FROM {table}
+        """)
 
-def seed_stores_and_items_if_empty():
-    c = conn()
-    cur = c.cursor()
+def migration_attr_columns(cur):
+    # JSON с кириллическими ключами -> шесть INTEGER колонок (фильтры/агрегаты прямо в SQL)
+    for table, key, json_col in (("characters", "user_id", "attrs"), ("npc", "id", "attrs"), ("items", "id", "bonus_json")):
+        for col in ATTR_COLUMNS:
+            _add_column_if_missing(cur, table, col, "INTEGER NOT NULL DEFAULT 0")
+        updates = []
+        for key_val, raw in cur.execute(f"SELECT {key}, {json_col} FROM {table}").fetchall():
+            try:
+                data = json.loads(raw or "{}")
+                values = attrs_to_row(data if isinstance(data, dict) else {})
+            except (ValueError, TypeError):
+                logger.warning("Bad %s.%s for %s=%s: %r, reset to zeros", table, json_col, key, key_val, raw)
+                values = attrs_to_row({})
+            updates.append(values + (key_val,))
+        cur.executemany(f"UPDATE {table} SET {', '.join(f'{col} = ?' for col in ATTR_COLUMNS)} WHERE {key} = ?", updates)
+        cur.execute(f"ALTER TABLE {table} DROP COLUMN {json_col}")
+
+def migration_combat_events(cur):
+    # append-only: строки только добавляются (пачками из COMBAT_EVENT_BUFFER)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS combat_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            encounter_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            kind TEXT NOT NULL,          -- player_attack / npc_attack / gm_damage / aoe
+            actor_id INTEGER,
+            actor_name TEXT,
+            target_id INTEGER,
+            target_name TEXT,
+            roll INTEGER,
+            base_dmg INTEGER,
+            armor INTEGER,
+            effective INTEGER,
+            hp_after INTEGER,
+            killed INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_combat_events_encounter ON combat_events(encounter_id, id)")
+
+def migration_stats(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS character_stats (
+            user_id INTEGER PRIMARY KEY,
+            {", ".join(f"{col} INTEGER NOT NULL DEFAULT 0" for col in STAT_COLUMNS)}
+        )
+    """)
+    for col in STAT_COLUMNS:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_character_stats_{col} ON character_stats({col})")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+
+def migration_character_version(cur):
+    # счётчик версий для compare-and-swap записей персонажа (update_character_cas)
+    _add_column_if_missing(cur, "characters", "version", "INTEGER NOT NULL DEFAULT 0")
+
+def migration_npc_templates(cur):
+    # шаблоны мобов для /spawn: hp ± hp_variance на каждый экземпляр
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS npc_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            weapon_id INTEGER,
+            armor_id INTEGER,
+            hp INTEGER NOT NULL,
+            hp_variance INTEGER NOT NULL DEFAULT 0,
+            damage INTEGER NOT NULL DEFAULT 0,
+            {", ".join(f"{col} INTEGER NOT NULL DEFAULT 0" for col in ATTR_COLUMNS)}
+        )
+    """)
+
+def migration_npc_archive(cur):
+    # погибшие мобы переносятся сюда обслуживанием БД; колонки — как у npc на момент миграции
+    cols = [(r[1], r[2]) for r in cur.execute("PRAGMA table_info(npc)").fetchall() if r[1] != "id"]
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS npc_archive (
+            id INTEGER PRIMARY KEY,
+            {", ".join(f"{name} {decl}" for name, decl in cols)},
+            archived_at INTEGER NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_npc_archive_archived_at ON npc_archive (archived_at)")
+
+# порядок важен: индекс i -> user_version i+1. Новые шаги только дописывать в конец.
+MIGRATIONS = [
+    migration_base_schema,
+    migration_fix_drift,
+    migration_indexes,
+    migration_search_index,
+    migration_attr_columns,
+    migration_combat_events,
+    migration_stats,
+    migration_character_version,
+    migration_npc_templates,
+    migration_npc_archive,
+]
+
+def seed_stores_and_items_if_empty(cur):
     # seed stores if empty
     cur.execute("SELECT count(*) FROM stores")
     if cur.fetchone()[0] == 0:
@@ -128,7 +370,6 @@ def seed_stores_and_items_if_empty():
             (2, "Бронник", 0),
         ]
         cur.executemany("INSERT INTO stores (id, name, active) VALUES (?,?,?)", stores)
-        c.commit()
     # seed items if empty
     cur.execute("SELECT count(*) FROM items")
     if cur.fetchone()[0] == 0:
@@ -160,11 +401,9 @@ def seed_stores_and_items_if_empty():
             ("Наручи стабилизации", "аксессуар", 0, json.dumps(mb(внимание=1), ensure_ascii=False), 18, 2, 0, 0),
         ]
         cur.executemany(
-            "INSERT INTO items (name,type,damage,bonus_json,cost,store_id,hidden,armor) VALUES (?,?,?,?,?,?,?)",
+            "INSERT INTO items (name,type,damage,bonus_json,cost,store_id,hidden,armor) VALUES (?,?,?,?,?,?,?,?)",
             items
         )
-        c.commit()
-    c.close()
 
 def migrate_characters_defaults():
     # ensure existing characters have inventory,gold,hp fields set (basic migration)
@@ -194,34 +433,142 @@ def migrate_characters_defaults():
     c.commit()
     c.close()
 
+# ---------- STATS ----------
+# счётчик -> подпись для /top; порядок = порядок колонок character_stats
+STAT_LABELS = {
+    "damage_dealt": "Урон",
+    "kills": "Убийства",
+    "gold_spent": "Потрачено золота",
+    "checks_passed": "Пройдено испытаний",
+}
+STAT_COLUMNS = list(STAT_LABELS)
+
+def bump_stats(cur, user_id: int, **deltas: int):
+    """
+    Инкремент счётчиков персонажа и кампании в текущей транзакции cur.
+    Коммит делает вызывающий вместе со своей записью (урон, убийство, покупка).
+    """
+    deltas = {k: int(v) for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    cols = list(deltas)
+    cur.execute(f"""
+        INSERT INTO character_stats (user_id, {", ".join(cols)}) VALUES (?, {", ".join("?" * len(cols))})
+        ON CONFLICT(user_id) DO UPDATE SET {", ".join(f"{col} = {col} + excluded.{col}" for col in cols)}
+    """, [user_id] + [deltas[col] for col in cols])
+    cur.executemany("""
+        INSERT INTO campaign_stats (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    """, list(deltas.items()))
+
+def load_leaderboard(stat: str, limit: int = 10) -> List[tuple]:
+    # ORDER BY по индексированной колонке: top-N без скана таблицы
+    c = conn()
+    rows = c.execute(f"""
+        SELECT coalesce(ch.username, s.user_id), s.{stat}
+        FROM character_stats s LEFT JOIN characters ch ON ch.user_id = s.user_id
+        WHERE s.{stat} > 0 ORDER BY s.{stat} DESC LIMIT ?
+    """, (limit,)).fetchall()
+    c.close()
+    return rows
+
+def load_campaign_stats() -> Dict[str, int]:
+    c = conn()
+    rows = c.execute("SELECT name, value FROM campaign_stats").fetchall()
+    c.close()
+    return dict(rows)
+
 # ---------- NPC HELPERS ----------
-def create_npc(name: str, attrs: Dict[str,int], weapon_id: Optional[int], armor_id: Optional[int], hp: int, in_combat: int = 0, damage: int = 0):
+def create_npc(name: str, attrs: Dict[str,int], weapon_id: Optional[int], armor_id: Optional[int], hp: int, in_combat: int = 0, damage: int = 0) -> int:
     c = conn(); cur = c.cursor()
-    cur.execute("""
-        INSERT INTO npc (name, attrs, weapon_id, armor_id, hp, in_combat, damage)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (name, json.dumps(attrs, ensure_ascii=False), weapon_id, armor_id, hp, int(in_combat), damage))
+    cur.execute(f"""
+        INSERT INTO npc (name, weapon_id, armor_id, hp, in_combat, damage, {ATTR_SQL})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (name, weapon_id, armor_id, hp, int(in_combat), damage) + attrs_to_row(attrs))
+    npc_id = cur.lastrowid
     c.commit(); c.close()
+    return npc_id
 
 def load_npc_full(npc_id: int) -> Optional[Dict[str,Any]]:
     c = conn(); cur = c.cursor()
-    cur.execute("SELECT id, name, attrs, weapon_id, armor_id, hp, in_combat FROM npc WHERE id = ?", (npc_id,))
+    cur.execute(f"SELECT id, name, weapon_id, armor_id, hp, in_combat, damage, {ATTR_SQL} FROM npc WHERE id = ?", (npc_id,))
     row = cur.fetchone(); c.close()
     if not row: return None
-    _id, name, attrs_json, weapon_id, armor_id, hp, in_combat = row
-    try:
-        attrs = json.loads(attrs_json or "{}")
-    except Exception:
-        attrs = {}
+    _id, name, weapon_id, armor_id, hp, in_combat, damage = row[:7]
+    attrs = attrs_from_row(row[7:])
     weapon = get_item_by_id(weapon_id) if weapon_id else None
     armor = get_item_by_id(armor_id) if armor_id else None
     return {
         "id": _id, "name": name, "attrs": attrs,
         "weapon_id": weapon_id, "weapon": weapon,
         "armor_id": armor_id, "armor": armor,
-        "hp": hp, "in_combat": bool(in_combat)
+        "hp": hp, "in_combat": bool(in_combat), "damage": damage or 0
     }
 
+TEMPLATE_SQL = f"id, name, weapon_id, armor_id, hp, hp_variance, damage, {ATTR_SQL}"
+SPAWN_MAX = 500
+
+def template_from_row(row) -> Dict[str, Any]:
+    _id, name, weapon_id, armor_id, hp, hp_variance, damage = row[:7]
+    return {"id": _id, "name": name, "weapon_id": weapon_id, "armor_id": armor_id, "hp": hp,
+            "hp_variance": hp_variance, "damage": damage, "attrs": attrs_from_row(row[7:])}
+
+def get_npc_template(key: str) -> Optional[Dict[str, Any]]:
+    # по id или имени без учёта регистра (lower() в SQLite не знает кириллицу — сравниваем в Python)
+    if key.isdigit():
+        c = conn()
+        row = c.execute(f"SELECT {TEMPLATE_SQL} FROM npc_templates WHERE id = ?", (int(key),)).fetchone()
+        c.close()
+        return template_from_row(row) if row else None
+    return next((t for t in list_npc_templates() if t["name"].casefold() == key.casefold()), None)
+
+def list_npc_templates() -> List[Dict[str, Any]]:
+    c = conn()
+    rows = c.execute(f"SELECT {TEMPLATE_SQL} FROM npc_templates ORDER BY name").fetchall()
+    c.close()
+    return [template_from_row(r) for r in rows]
+
+def save_npc_template(name: str, hp: int, damage: int = 0, hp_variance: int = 0,
+                      weapon_id: Optional[int] = None, armor_id: Optional[int] = None,
+                      attrs: Optional[Dict[str, int]] = None):
+    c = conn()
+    c.execute(f"""
+        INSERT INTO npc_templates (name, weapon_id, armor_id, hp, hp_variance, damage, {ATTR_SQL})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET weapon_id = excluded.weapon_id, armor_id = excluded.armor_id, hp = excluded.hp,
+            hp_variance = excluded.hp_variance, damage = excluded.damage,
+            {", ".join(f"{col} = excluded.{col}" for col in ATTR_COLUMNS)}
+    """, (name, weapon_id, armor_id, hp, hp_variance, damage) + attrs_to_row(attrs or {}))
+    c.commit()
+    c.close()
+
+def spawn_npcs(template: Dict[str, Any], count: int, hp_variance: Optional[int] = None) -> List[str]:
+    """
+    N экземпляров шаблона одним executemany: имена «гоблин 1..N» (нумерация продолжает уже существующих),
+    сразу in_combat, HP = hp ± variance (не меньше 1), броски делаются пачкой заранее.
+    """
+    variance = abs(int(template["hp_variance"] or 0) if hp_variance is None else hp_variance)  # старые строки БД не проверялись
+    hps = [max(1, template["hp"] + random.randint(-variance, variance)) for _ in range(count)]
+    c = conn()
+    cur = c.cursor()
+    prefix = template["name"] + " "
+    last = 0
+    for (name,) in cur.execute("SELECT name FROM npc WHERE substr(name, 1, ?) = ?", (len(prefix), prefix)):
+        tail = name[len(prefix):]
+        if tail.isdigit():
+            last = max(last, int(tail))
+    names = [f"{prefix}{last + i + 1}" for i in range(count)]
+    attrs = attrs_to_row(template["attrs"])
+    cur.executemany(f"""
+        INSERT INTO npc (name, weapon_id, armor_id, hp, in_combat, damage, {ATTR_SQL})
+        VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+    """, [(name, template["weapon_id"], template["armor_id"], hp, template["damage"]) + attrs
+          for name, hp in zip(names, hps)])
+    c.commit()
+    c.close()
+    logger.info("Spawned %s x %s (hp %s..%s)", count, template["name"], min(hps), max(hps))
+    return names
+
 def get_npcs_in_combat() -> List[Dict[str,Any]]:
     c = conn(); cur = c.cursor()
     cur.execute("SELECT id FROM npc WHERE in_combat=1")
@@ -233,9 +580,10 @@ def set_npc_in_combat(npc_id: int, val: bool):
     cur.execute("UPDATE npc SET in_combat = ? WHERE id = ?", (1 if val else 0, npc_id))
     c.commit(); c.close()
 
-def apply_damage_to_npc(npc_id: int, incoming_dmg: int) -> Dict[str,Any]:
+def apply_damage_to_npc(npc_id: int, incoming_dmg: int, attacker_id: Optional[int] = None) -> Dict[str,Any]:
     """
     Вычитает броню NPC и уменьшает hp. Возвращает dict с keys: effective, new_hp, armor_val, was_killed
+    Если указан attacker_id, в той же транзакции растут его счётчики урона/убийств.
     """
     npc = load_npc_full(npc_id)
     if not npc:
@@ -249,6 +597,9 @@ def apply_damage_to_npc(npc_id: int, incoming_dmg: int) -> Dict[str,Any]:
     new_hp = max(0, int(npc["hp"]) - effective)
     c = conn(); cur = c.cursor()
     cur.execute("UPDATE npc SET hp = ? WHERE id = ?", (new_hp, npc_id))
+    if attacker_id is not None:
+        bump_stats(cur, attacker_id, damage_dealt=int(npc["hp"]) - new_hp,
+                   kills=1 if new_hp == 0 and int(npc["hp"]) > 0 else 0)
     c.commit(); c.close()
     return {"effective": effective, "new_hp": new_hp, "armor": armor_val, "was_killed": new_hp == 0}
 
@@ -271,12 +622,226 @@ def npc_attack_player(npc_id: int, target_user_id: int) -> Dict[str,Any]:
         if arm:
             armor_val = int(arm.get("armor") or 0)
     effective = max(0, dmg - armor_val)
-    new_hp = max(0, target.get("hp",0) - effective)
-    c = conn(); cur = c.cursor()
-    cur.execute("UPDATE characters SET hp = ? WHERE user_id = ?", (new_hp, target_user_id))
-    c.commit(); c.close()
-    return {"roll": roll, "base_dmg": dmg, "armor": armor_val, "effective": effective, "new_hp": new_hp}
+    res = update_character_cas(target_user_id, lambda ch: {"hp": max(0, ch["hp"] - effective)})
+    if not res:
+        raise ValueError("Target not found")
+    return {"roll": roll, "base_dmg": dmg, "armor": armor_val, "effective": effective, "new_hp": res["changes"]["hp"]}
+
+
+# ====== MASS BATTLE ======
+# Группа мобов — имя без порядкового номера («гоблин 12» -> «гоблин»), как их называет /spawn.
+NPC_GROUP_SQL = "COALESCE(NULLIF(rtrim(rtrim(name, '0123456789'), ' '), ''), name)"
+
+def npc_group(name: str) -> str:
+    return name.rstrip("0123456789").rstrip(" ") or name
+
+def load_battle(group: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Мобы в бою одним запросом в параллельных массивах: ids, hp, armor (броня надетого предмета),
+    damage (бонус моба + урон оружия, без броска d10); names/groups — обычные списки той же длины.
+    """
+    c = conn()
+    rows = c.execute(f"""
+        SELECT n.id, n.name, n.hp, COALESCE(a.armor, 0), n.damage + COALESCE(w.damage, 0)
+        FROM npc n LEFT JOIN items a ON a.id = n.armor_id LEFT JOIN items w ON w.id = n.weapon_id
+        WHERE n.in_combat = 1 {"AND " + NPC_GROUP_SQL.replace("name", "n.name") + " = ?" if group else ""}
+        ORDER BY n.id
+    """, (group,) if group else ()).fetchall()
+    c.close()
+    return {
+        "ids": array("q", (r[0] for r in rows)),
+        "names": [r[1] for r in rows],
+        "groups": [npc_group(r[1]) for r in rows],
+        "hp": array("l", (r[2] for r in rows)),
+        "armor": array("l", (int(r[3] or 0) for r in rows)),
+        "damage": array("l", (int(r[4] or 0) for r in rows)),
+    }
+
+def persist_npc_hp(cur, ids, hps):
+    # один UPDATE на любое число мобов; погибшие выходят из боя
+    cur.execute("""
+        UPDATE npc SET hp = json_extract(u.value, '$[1]'), in_combat = json_extract(u.value, '$[1]') > 0
+        FROM json_each(?) AS u WHERE npc.id = json_extract(u.value, '$[0]')
+    """, (json.dumps(list(zip(ids, hps))),))
 
+def aoe_damage(battle: Dict[str, Any], dmg: int, attacker_id: Optional[int] = None,
+               attacker_name: str = "GM") -> Dict[str, Any]:
+    """
+    Урон по площади: броня вычитается у каждой цели, новые HP и погибшие считаются одним проходом по массивам,
+    в БД — один UPDATE через json_each (погибшие выходят из боя, как в pick_attack).
+    """
+    old_hp = battle["hp"]
+    effective = array("l", (max(0, dmg - a) for a in battle["armor"]))
+    new_hp = array("l", (max(0, h - e) for h, e in zip(old_hp, effective)))
+    killed = [i for i, (h, n) in enumerate(zip(old_hp, new_hp)) if h > 0 and n == 0]
+    total = sum(old_hp) - sum(new_hp)
+    c = conn()
+    cur = c.cursor()
+    persist_npc_hp(cur, battle["ids"], new_hp)
+    if attacker_id is not None:
+        bump_stats(cur, attacker_id, damage_dealt=total, kills=len(killed))
+    c.commit()
+    c.close()
+    hits = [i for i in range(len(effective)) if effective[i]]
+    if hits:
+        log_combat_events(
+            [("aoe", attacker_id or 0, attacker_name, battle["ids"][i], battle["names"][i], None, dmg,
+              battle["armor"][i], effective[i], new_hp[i], new_hp[i] == 0) for i in hits],
+            panel_line=f"{attacker_name} → {len(hits)} целей: −{total}" + (f", ☠ {len(killed)}" if killed else ""))
+    battle["hp"] = new_hp
+    return {"hit": sum(1 for e in effective if e), "killed": [battle["names"][i] for i in killed], "damage": total}
+
+def battle_summary(battle: Dict[str, Any]) -> List[str]:
+    # «гоблин: 12 живы, HP 96» по группам в порядке появления
+    groups: Dict[str, List[int]] = {}
+    for g, h in zip(battle["groups"], battle["hp"]):
+        alive = groups.setdefault(g, [0, 0])
+        if h > 0:
+            alive[0] += 1
+            alive[1] += h
+    return [f"{g}: {n} в бою, HP {hp}" for g, (n, hp) in groups.items() if n]
+
+def resolve_npc_in_group(npc_id: int, weakest: bool = False) -> Optional[int]:
+    # кнопка пикера несёт id первого моба группы; цель — живой моб той же группы (самый слабый или первый)
+    c = conn()
+    row = c.execute(f"""
+        SELECT id FROM npc WHERE in_combat = 1 AND hp > 0
+          AND {NPC_GROUP_SQL} = (SELECT {NPC_GROUP_SQL} FROM npc WHERE id = ?)
+        ORDER BY {"hp, id" if weakest else "id"} LIMIT 1
+    """, (npc_id,)).fetchone()
+    c.close()
+    return row[0] if row else None
+
+# ====== SIMULATOR ======
+# Монте-Карло боёв «персонаж против моба» по правилам pick_attack/npc_attack_player: игрок бьёт первым,
+# урон d10 + оружие − броня цели (не меньше 0). Все бои раунда считаются разом: эффективный урон
+# выбирается random.choices из 10 равновероятных значений, HP вычитаются map(operator.sub) —
+# на Python-уровне только фильтр живых боёв. Цена прогона — число «бой×раунд», поэтому число боёв
+# урезается так, чтобы ожидаемая работа укладывалась в max_work, а сам цикл жёстко останавливается на 2×max_work.
+SIM_FIGHTS = 100_000
+SIM_MAX_ROUNDS = 100
+SIM_WORK_BUDGET = 500_000  # бой×раунд на один прогон simulate_fights (~0.2 с); для предметов — на все вместе
+
+def _hit_table(attack_bonus: int, armor: int) -> List[int]:
+    return [max(0, roll + attack_bonus - armor) for roll in range(1, 11)]
+
+def sim_expected_rounds(player_hp: int, player_hits: List[int], npc_hp: int, npc_hits: List[int]) -> int:
+    # раундов до падения первого из бойцов при среднем уроне за удар
+    times = [hp * 10 / sum(hits) for hp, hits in ((npc_hp, player_hits), (player_hp, npc_hits)) if any(hits)]
+    return max(1, ceil(min(times)))
+
+def simulate_fights(player_hp: int, player_weapon: int, player_armor: int,
+                    npc_hp: int, npc_damage: int, npc_armor: int,
+                    fights: int = SIM_FIGHTS, max_rounds: int = SIM_MAX_ROUNDS,
+                    max_work: int = SIM_WORK_BUDGET) -> Dict[str, Any]:
+    """
+    player_weapon — урон оружия игрока, npc_damage — бонус моба + урон его оружия.
+    Возвращает доли побед/поражений/ничьих (ничья — никто не упал за max_rounds) и среднее число раундов.
+    fights уменьшается до max_work / ожидаемая длина боя; бои, не закончившиеся к 2×max_work, считаются
+    ничьими и помечаются truncated.
+    """
+    player_hits = _hit_table(player_weapon, npc_armor)
+    npc_hits = _hit_table(npc_damage, player_armor)
+    if not any(player_hits) and not any(npc_hits):
+        return {"fights": fights, "win_rate": 0.0, "loss_rate": 0.0, "draw_rate": 1.0, "avg_rounds": float(max_rounds),
+                "truncated": False}
+    expected = min(max_rounds, sim_expected_rounds(player_hp, player_hits, npc_hp, npc_hits))
+    fights = max(1, min(fights, max_work // expected))
+    work = 0
+    p_hp = [player_hp] * fights
+    n_hp = [npc_hp] * fights
+    wins = losses = 0
+    rounds_total = 0
+    rounds = 0
+    while n_hp and rounds < max_rounds and work < 2 * max_work:
+        work += len(n_hp)
+        rounds += 1
+        n_hp = list(map(operator.sub, n_hp, random.choices(player_hits, k=len(n_hp))))
+        alive = [h > 0 for h in n_hp]
+        won = len(alive) - sum(alive)
+        wins += won
+        rounds_total += won * rounds
+        if won:
+            n_hp = list(itertools.compress(n_hp, alive))
+            p_hp = list(itertools.compress(p_hp, alive))
+        p_hp = list(map(operator.sub, p_hp, random.choices(npc_hits, k=len(p_hp))))
+        alive = [h > 0 for h in p_hp]
+        lost = len(alive) - sum(alive)
+        losses += lost
+        rounds_total += lost * rounds
+        if lost:
+            n_hp = list(itertools.compress(n_hp, alive))
+            p_hp = list(itertools.compress(p_hp, alive))
+    draws = len(n_hp)
+    rounds_total += draws * rounds
+    return {"fights": fights, "win_rate": wins / fights, "loss_rate": losses / fights,
+            "draw_rate": draws / fights, "avg_rounds": rounds_total / fights,
+            "truncated": bool(draws) and rounds < max_rounds}
+
+def sim_player_from_character(char: Dict[str, Any]) -> Dict[str, Any]:
+    return {"name": char["username"], "hp": char["hp"] or char["max_hp"], "weapon_id": char.get("weapon_id"),
+            "armor_id": char.get("armor_id")}
+
+def sim_npc_stats(npc: Dict[str, Any]) -> Dict[str, Any]:
+    # моб или шаблон: урон = бонус + оружие, броня = предмет брони
+    weapon = get_item_by_id(npc.get("weapon_id"))
+    armor = get_item_by_id(npc.get("armor_id"))
+    return {"name": npc["name"], "hp": npc["hp"],
+            "damage": int(npc.get("damage") or 0) + int((weapon or {}).get("damage") or 0),
+            "armor": int((armor or {}).get("armor") or 0)}
+
+def resolve_sim_npc(key: str) -> Optional[Dict[str, Any]]:
+    # id моба или имя шаблона
+    npc = load_npc_full(int(key)) if key.isdigit() else get_npc_template(key)
+    return sim_npc_stats(npc) if npc else None
+
+def simulate_encounter(player: Dict[str, Any], npc: Dict[str, Any], fights: int = SIM_FIGHTS) -> Dict[str, Any]:
+    """
+    Базовая сборка игрока против моба плюс по каждому предмету каталога (оружие/броня):
+    победы с этим предметом вместо текущего и урон (или предотвращённый урон) за раунд на единицу золота.
+    """
+    weapon = get_item_by_id(player.get("weapon_id"))
+    armor = get_item_by_id(player.get("armor_id"))
+    w_dmg = int((weapon or {}).get("damage") or 0)
+    a_val = int((armor or {}).get("armor") or 0)
+    started = time.perf_counter()
+    base = simulate_fights(player["hp"], w_dmg, a_val, npc["hp"], npc["damage"], npc["armor"], fights)
+    base["seconds"] = time.perf_counter() - started
+    c = conn()
+    items = [item_from_row(r) for r in
+             c.execute(f"SELECT {ITEM_SQL} FROM items WHERE type IN ('оружие', 'броня') ORDER BY id").fetchall()]
+    c.close()
+    per_item = []
+    item_fights = max(1000, fights // 10)
+    item_work = max(1, SIM_WORK_BUDGET // max(1, len(items)))
+    for it in items:
+        if it["type"] == "оружие":
+            value = sum(_hit_table(int(it["damage"] or 0), npc["armor"])) / 10
+            res = simulate_fights(player["hp"], int(it["damage"] or 0), a_val, npc["hp"], npc["damage"], npc["armor"],
+                                  item_fights, max_work=item_work)
+        else:
+            hits = _hit_table(npc["damage"], 0)
+            value = (sum(hits) - sum(_hit_table(npc["damage"], int(it["armor"] or 0)))) / 10
+            res = simulate_fights(player["hp"], w_dmg, int(it["armor"] or 0), npc["hp"], npc["damage"], npc["armor"],
+                                  item_fights, max_work=item_work)
+        per_item.append({"name": it["name"], "type": it["type"], "cost": it["cost"], "per_round": value,
+                         "per_gold": value / it["cost"] if it["cost"] else None, "win_rate": res["win_rate"]})
+    per_item.sort(key=lambda r: (r["type"], -(r["per_gold"] or 0)))
+    return {"base": base, "items": per_item}
+
+def format_simulation(player: Dict[str, Any], npc: Dict[str, Any], res: Dict[str, Any]) -> str:
+    b = res["base"]
+    lines = [
+        f"{player['name']} (HP {player['hp']}) против {npc['name']} (HP {npc['hp']}, урон +{npc['damage']}, броня {npc['armor']})",
+        f"{b['fights']} боёв за {b['seconds']:.2f} с: победы {b['win_rate']:.1%}, поражения {b['loss_rate']:.1%}, "
+        f"ничьи {b['draw_rate']:.1%}{' (часть боёв прервана лимитом)' if b['truncated'] else ''}, "
+        f"в среднем {b['avg_rounds']:.1f} раунда",
+        "Предмет: урон/раунд (оружие) или защита/раунд (броня), на 1g, победы с ним:",
+    ]
+    for it in res["items"]:
+        per_gold = f"{it['per_gold']:.2f}" if it["per_gold"] is not None else "—"
+        lines.append(f"  {it['type']} {it['name']} ({it['cost']}g): {it['per_round']:.2f}, {per_gold}/g, {it['win_rate']:.0%}")
+    return "\n".join(lines)
 
 # ====== CHARACTER HELPERS ======
 def save_character_full(user_id: int, username: str, race: str, cls: str, attrs: Dict[str,int],
@@ -291,63 +856,18 @@ def save_character_full(user_id: int, username: str, race: str, cls: str, attrs:
             hp = 10
     c = conn()
     cur = c.cursor()
-    cur.execute("""
-      INSERT OR REPLACE INTO characters (user_id, username, race, class, attrs, hp, inventory, weapon_id, armor_id, gold)
-      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, username, race, cls, json.dumps(attrs, ensure_ascii=False), hp,
-          inventory_json, weapon, armor, gold))
+    cur.execute(f"""
+      INSERT OR REPLACE INTO characters (user_id, username, race, class, hp, inventory, weapon_id, armor_id, gold, {ATTR_SQL}, version)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+              COALESCE((SELECT version + 1 FROM characters WHERE user_id = ?), 0))
+    """, (user_id, username, race, cls, hp,
+          inventory_json, weapon, armor, gold) + attrs_to_row(attrs) + (user_id,))
     c.commit()
     c.close()
+    touch_character(user_id)
     logger.info("Saved character %s (%s) inv=%s weapon=%s armor=%s gold=%s hp=%s",
                 username, user_id, inventory_json, weapon, armor, gold, hp)
 
-def load_all_characters() -> List[Dict[str, Any]]:
-    c = conn()
-    cur = c.cursor()
-    cur.execute("SELECT user_id, username, race, class, attrs, inventory, weapon_id, armor_id, gold, hp FROM characters")
-    rows = cur.fetchall()
-    c.close()
-    res = []
-    for (user_id, username, race, cls, attrs_json, inv_json, weapon_id, armor_id, gold, hp) in rows:
-        attrs = json.loads(attrs_json or "{}")
-        # inventory ids -> names
-        inv_ids = json.loads(inv_json or "[]")
-        inv_names = []
-        for iid in inv_ids:
-            item = get_item_by_id(iid)
-            if item:
-                inv_names.append(item["name"])
-            else:
-                inv_names.append(f"<missing id:{iid}>")
-        # weapon
-        weapon = get_item_by_id(weapon_id) if weapon_id else None
-        armor = get_item_by_id(armor_id) if armor_id else None
-        # weapon/armor convenient fields
-        weapon_name = weapon["name"] if weapon else None
-        weapon_damage = int(weapon["damage"]) if weapon and weapon.get("damage") is not None else 0
-        armor_name = armor["name"] if armor else None
-        armor_value = int(armor.get("armor") or 0) if armor else 0
-
-        # build record
-        res.append({
-            "user_id": user_id,
-            "username": username,
-            "race": race,
-            "class": cls,
-            "attrs": attrs,
-            "inventory_ids": inv_ids,
-            "inventory_names": inv_names,
-            "weapon_id": weapon_id,
-            "weapon_name": weapon_name,
-            "weapon_damage": weapon_damage,
-            "armor_id": armor_id,
-            "armor_name": armor_name,
-            "armor_value": armor_value,
-            "gold": gold,
-            "hp": hp
-        })
-    return res
-
 def load_character_full(user_id: int) -> Optional[Dict[str, Any]]:
     """
     Загружает персонажа. Ожидается, что characters.inventory хранит JSON-массив ID (ints).
@@ -356,7 +876,7 @@ def load_character_full(user_id: int) -> Optional[Dict[str, Any]]:
     c = conn()
     cur = c.cursor()
     cur.execute(
-        "SELECT username, race, class, attrs, inventory, weapon_id, armor_id, gold, hp FROM characters WHERE user_id = ?",
+        f"SELECT username, race, class, inventory, weapon_id, armor_id, gold, hp, version, {ATTR_SQL} FROM characters WHERE user_id = ?",
         (user_id,)
     )
     row = cur.fetchone()
@@ -364,13 +884,10 @@ def load_character_full(user_id: int) -> Optional[Dict[str, Any]]:
     if not row:
         return None
 
-    username, race, cls, attrs_json, inv_json, weapon_id, armor_id, gold, hp = row
+    username, race, cls, inv_json, weapon_id, armor_id, gold, hp, version = row[:9]
 
     # attrs
-    try:
-        attrs = json.loads(attrs_json or "{}")
-    except Exception:
-        attrs = {}
+    attrs = attrs_from_row(row[9:])
 
     # inventory_ids (assume list of ints)
     try:
@@ -423,51 +940,222 @@ def load_character_full(user_id: int) -> Optional[Dict[str, Any]]:
         "armor_value": armor_value,
         "gold": gold or 0,
         "hp": hp or 0,
-        "max_hp": max_hp
+        "max_hp": max_hp,
+        "version": version
     }
 
+CAS_RETRIES = 20
+
+def load_character_state(user_id: int) -> Optional[Dict[str, Any]]:
+    # только изменяемые поля одним запросом — короткое окно между чтением и CAS-записью
+    c = conn()
+    row = c.execute("SELECT username, gold, hp, inventory, weapon_id, armor_id, version FROM characters WHERE user_id = ?",
+                    (user_id,)).fetchone()
+    c.close()
+    if not row:
+        return None
+    username, gold, hp, inv_json, weapon_id, armor_id, version = row
+    try:
+        inventory_ids = json.loads(inv_json or "[]")
+    except ValueError:
+        inventory_ids = []
+    return {"user_id": user_id, "username": username, "gold": gold or 0, "hp": hp or 0,
+            "inventory_ids": inventory_ids if isinstance(inventory_ids, list) else [],
+            "weapon_id": weapon_id, "armor_id": armor_id, "version": version}
+
+def update_character_cas(user_id: int, compute, after=None) -> Optional[Dict[str, Any]]:
+    """
+    Оптимистичная запись персонажа. compute(char) по свежему снимку load_character_state возвращает новые значения колонок
+    (inventory — списком id) или None, если действие невозможно. UPDATE проходит только при той же version,
+    иначе снимок перечитывается и compute вызывается снова. after(cur, char, changes) — в той же транзакции.
+    Возвращает {"char": снимок, "changes": changes} или None, если персонажа нет.
+    """
+    for attempt in range(CAS_RETRIES):
+        char = load_character_state(user_id)
+        if not char:
+            return None
+        changes = compute(char)
+        if changes is None:
+            return {"char": char, "changes": None}
+        values = [json.dumps(v, ensure_ascii=False) if col == "inventory" else v for col, v in changes.items()]
+        c = conn()
+        cur = c.cursor()
+        cur.execute(f"""
+            UPDATE characters SET {", ".join(f"{col} = ?" for col in changes)}, version = version + 1
+            WHERE user_id = ? AND version = ?
+        """, values + [user_id, char["version"]])
+        if cur.rowcount == 1:
+            if after:
+                after(cur, char, changes)
+            c.commit()
+            c.close()
+            touch_character(user_id)
+            return {"char": char, "changes": changes}
+        c.rollback()
+        c.close()
+        # конфликт возможен только с другим потоком/процессом; короткая случайная пауза разводит писателей
+        time.sleep(random.uniform(0, min(0.05, 0.001 * 2 ** attempt)))
+    raise RuntimeError(f"Character {user_id}: too many concurrent updates")
+
+def heal_cap(strength: int, race: str) -> int:
+    # потолок HP для шага GM «Лечение»
+    return round((strength + int(RACE_BONUSES.get(race, {}).get("сила", 0) or 0)) * 2.2)
+
+def full_heal_hp(strength: int, race: str) -> int:
+    # HP после шага GM «Здоровье»
+    max_hp = heal_cap(strength, race)
+    return 10 if max_hp < 5 else max_hp
+
+GRANT_KINDS = ("gold", "heal", "item")
+
+def bulk_grant(kind: str, amount: Optional[int] = None, item: Optional[Dict[str, Any]] = None,
+               race: Optional[str] = None, cls: Optional[str] = None, alive_only: bool = False) -> Dict[str, Any]:
+    """
+    Массовая выдача всем (или отфильтрованным) персонажам одной транзакцией:
+    gold — +amount золота (не ниже 0); heal — +amount HP до потолка «Лечения», amount None — как «Здоровье»;
+    item — продажа предмета по правилам «Торговли» (кому не хватает золота, пропускаются).
+    """
+    where, params = ["1 = 1"], []
+    if race:
+        where.append("race = ?")
+        params.append(race)
+    if cls:
+        where.append("class = ?")
+        params.append(cls)
+    if alive_only:
+        where.append("hp > 0")
+    c = conn()
+    c.isolation_level = None
+    cur = c.cursor()
+    cur.execute("BEGIN IMMEDIATE")  # между чтением и записью никто не вклинится
+    try:
+        rows = cur.execute(f"""
+            SELECT user_id, username, race, strength, COALESCE(hp, 0), COALESCE(gold, 0), inventory FROM characters
+            WHERE {" AND ".join(where)} ORDER BY user_id
+        """, params).fetchall()
+        updates, skipped = [], []
+        for user_id, username, c_race, strength, hp, gold, inv_json in rows:
+            if kind == "gold":
+                updates.append((max(0, gold + amount), user_id))
+            elif kind == "heal":
+                new_hp = full_heal_hp(strength, c_race) if amount is None else min(heal_cap(strength, c_race), hp + amount)
+                updates.append((new_hp, user_id))
+            elif gold < item["cost"]:
+                skipped.append(username)
+            else:
+                inventory = json.loads(inv_json or "[]") + [item["id"]]
+                updates.append((gold - item["cost"], json.dumps(inventory, ensure_ascii=False), user_id))
+                bump_stats(cur, user_id, gold_spent=item["cost"])
+        set_sql = {"gold": "gold = ?", "heal": "hp = ?", "item": "gold = ?, inventory = ?"}[kind]
+        cur.executemany(f"UPDATE characters SET {set_sql}, version = version + 1 WHERE user_id = ?", updates)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        c.close()
+    for values in updates:
+        touch_character(values[-1])
+    logger.info("Bulk grant %s amount=%s item=%s: %s changed, %s skipped",
+                kind, amount, item and item["id"], len(updates), len(skipped))
+    return {"changed": len(updates), "skipped": skipped}
+
+def sell_item_to_character(user_id: int, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # GM продаёт предмет: цена списывается с игрока, id добавляется в инвентарь; changes None — не хватает золота
+    cost = item["cost"]
+    return update_character_cas(
+        user_id,
+        lambda ch: {"gold": ch["gold"] - cost, "inventory": ch["inventory_ids"] + [item["id"]]} if ch["gold"] >= cost else None,
+        after=lambda cur, ch, changes: bump_stats(cur, user_id, gold_spent=cost),
+    )
+
+def equip_item(user_id: int, item_id: int, typ: str) -> Optional[Dict[str, Any]]:
+    # предмет из инвентаря в слот оружия/брони, прежний — обратно в инвентарь; changes None — предмета уже нет
+    def compute(ch):
+        inventory = ch["inventory_ids"][:]
+        if item_id not in inventory:
+            return None
+        inventory.remove(item_id)
+        slot = "weapon_id" if typ == "оружие" else "armor_id"
+        if ch.get(slot):
+            inventory.append(ch[slot])
+        return {slot: item_id, "inventory": inventory}
+    return update_character_cas(user_id, compute)
+
+
+def iter_character_list_pages(race: Optional[str] = None, cls: Optional[str] = None, page_size: int = 40):
+    """
+    Постранично отдаёт строки для /list: (user_id, username, race, class, урон оружия, броня).
+    Keyset по user_id: каждая страница — отдельный короткий запрос, соединение не держится между страницами.
+    """
+    where = ["c.user_id > ?"]
+    params: List[Any] = []
+    if race:
+        where.append("c.race = ?")
+        params.append(race)
+    if cls:
+        where.append("c.class = ?")
+        params.append(cls)
+    sql = f"""
+        SELECT c.user_id, c.username, c.race, c.class, COALESCE(w.damage, 0), COALESCE(a.armor, 0)
+        FROM characters c
+        LEFT JOIN items w ON w.id = c.weapon_id
+        LEFT JOIN items a ON a.id = c.armor_id
+        WHERE {' AND '.join(where)}
+        ORDER BY c.user_id
+        LIMIT ?
+    """
+    last_id = -1
+    while True:
+        c = conn()
+        rows = c.execute(sql, [last_id] + params + [page_size]).fetchall()
+        c.close()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
 
 # ====== ITEMS HELPERS ======
+ITEM_SQL = f"id, name, type, damage, cost, store_id, armor, {ATTR_SQL}"
+
+def item_from_row(row) -> Dict[str, Any]:
+    _id, name, typ, dmg, cost, store_id, armor = row[:7]
+    return {"id": _id, "name": name, "type": typ, "damage": dmg, "bonus": attrs_from_row(row[7:]),
+            "cost": cost, "store_id": store_id, "armor": armor}
 
 def get_item_by_id(item_id: int) -> Optional[Dict[str, Any]]:
     if item_id is None:
         return None
     c = conn()
     cur = c.cursor()
-    cur.execute("SELECT id, name, type, damage, bonus_json, cost, store_id, armor FROM items WHERE id = ?", (item_id,))
+    cur.execute(f"SELECT {ITEM_SQL} FROM items WHERE id = ?", (item_id,))
     row = cur.fetchone()
     c.close()
     if not row:
         return None
-    _id, name, typ, dmg, bonus_json, cost, store_id, armor = row
-    bonus = json.loads(bonus_json) if bonus_json else zero_bonus()
-    return {"id": _id, "name": name, "type": typ, "damage": dmg, "bonus": bonus, "cost": cost, "store_id": store_id, "armor": armor}
+    return item_from_row(row)
 
 def get_all_items_active_store() -> List[Dict[str, Any]]:
     # returns items for active store(s) - but we ensure only one active
     c = conn()
     cur = c.cursor()
-    cur.execute("SELECT id, name, type, damage, bonus_json, cost, store_id, armor FROM items WHERE hidden = 0 AND store_id IN (SELECT id FROM stores WHERE active=1)")
+    cur.execute(f"SELECT {ITEM_SQL} FROM items WHERE hidden = 0 AND store_id IN (SELECT id FROM stores WHERE active=1)")
     rows = cur.fetchall()
     c.close()
-    res = []
-    for r in rows:
-        _id, name, typ, dmg, bonus_json, cost, store_id, armor = r
-        bonus = json.loads(bonus_json) if bonus_json else zero_bonus()
-        res.append({"id": _id, "name": name, "type": typ, "damage": dmg, "bonus": bonus, "cost": cost, "store_id": store_id, "armor":armor})
-    return res
+    return [item_from_row(r) for r in rows]
 
 def get_item_by_name(name: str) -> Optional[Dict[str, Any]]:
     c = conn()
     cur = c.cursor()
-    cur.execute("SELECT id, name, type, damage, bonus_json, cost, store_id, armor FROM items WHERE name = ?", (name,))
+    cur.execute(f"SELECT {ITEM_SQL} FROM items WHERE name = ?", (name,))
     row = cur.fetchone()
     c.close()
     if not row:
         return None
-    _id, name, typ, dmg, bonus_json, cost, store_id, armor = row
-    bonus = json.loads(bonus_json) if bonus_json else zero_bonus()
-    return {"id": _id, "name": name, "type": typ, "damage": dmg, "bonus": bonus, "cost": cost, "store_id": store_id, "armor":armor}
+    return item_from_row(row)
 
 def get_active_store() -> Optional[Dict[str, Any]]:
     c = conn()
@@ -485,20 +1173,10 @@ def set_active_store(store_id: int):
     cur.execute("UPDATE stores SET active = CASE WHEN id = ? THEN 1 ELSE 0 END", (store_id,))
     c.commit()
     c.close()
+    bump_render_version("shop")
 
-def ensure_flags_table():
-    c = conn()
-    cur = c.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS flags (
-        name TEXT PRIMARY KEY,
-        value INTEGER NOT NULL
-    )
-    """)
-    # seed default if not exists
-    cur.execute("INSERT OR IGNORE INTO flags (name, value) VALUES ('shop_enabled', 1)")
-    c.commit()
-    c.close()
+# флаги пишет только этот процесс, поэтому значения держим в памяти после первого чтения
+FLAG_CACHE: Dict[str, int] = {}
 
 def set_flag(name: str, val: int):
     c = conn()
@@ -506,14 +1184,558 @@ def set_flag(name: str, val: int):
     cur.execute("INSERT INTO flags (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name, val))
     c.commit()
     c.close()
+    FLAG_CACHE[name] = val
+    bump_render_version("shop")
 
 def get_flag(name: str) -> int:
+    if name in FLAG_CACHE:
+        return FLAG_CACHE[name]
     c = conn()
     cur = c.cursor()
     cur.execute("SELECT value FROM flags WHERE name = ?", (name,))
     r = cur.fetchone()
     c.close()
-    return r[0] if r else 0
+    FLAG_CACHE[name] = r[0] if r else 0
+    return FLAG_CACHE[name]
+
+# ====== RENDER CACHE ======
+# Готовый текст /show и /shop по ключу сущности + версии. Версии растут при любой записи:
+# ("character", user_id) — персонаж, "shop" — смена магазина/флага, "catalog" — импорт предметов.
+# Офлайн-импорт через CLI в другом процессе кэш не сбрасывает — после него бота нужно перезапустить.
+RENDER_CACHE_MAX = 5000
+RENDER_VERSIONS: Dict[Any, int] = {}
+RENDER_CACHE: "OrderedDict[Any, tuple]" = OrderedDict()
+
+def bump_render_version(*key):
+    key = key if len(key) > 1 else key[0]
+    RENDER_VERSIONS[key] = RENDER_VERSIONS.get(key, 0) + 1
+
+def touch_character(user_id: int):
+    bump_render_version("character", user_id)
+
+def _render_stamp(key) -> tuple:
+    return (RENDER_VERSIONS.get(key, 0), RENDER_VERSIONS.get("catalog", 0))
+
+def get_cached_render(key) -> Optional[str]:
+    entry = RENDER_CACHE.get(key)
+    if entry is None or entry[0] != _render_stamp(key):
+        return None
+    RENDER_CACHE.move_to_end(key)
+    return entry[1]
+
+def put_cached_render(key, text: str):
+    RENDER_CACHE[key] = (_render_stamp(key), text)
+    RENDER_CACHE.move_to_end(key)
+    while len(RENDER_CACHE) > RENDER_CACHE_MAX:
+        RENDER_CACHE.popitem(last=False)
+
+# ====== COMBAT EVENTS ======
+# События боя копятся в памяти и пишутся одной транзакцией: при COMBAT_EVENT_FLUSH_SIZE
+# событиях или через COMBAT_EVENT_FLUSH_DELAY секунд после первого непринятого события.
+COMBAT_EVENT_FLUSH_SIZE = 50
+COMBAT_EVENT_FLUSH_DELAY = 2.0
+COMBAT_EVENTS_PAGE_SIZE = 20
+COMBAT_EVENT_BUFFER: List[tuple] = []
+_combat_flush_handle: Optional[asyncio.TimerHandle] = None
+
+def current_encounter_id() -> int:
+    return get_flag("encounter_id")
+
+def log_combat_event(kind: str, actor_id: Optional[int], actor_name: Optional[str],
+                     target_id: Optional[int], target_name: Optional[str], roll: Optional[int],
+                     base_dmg: int, armor: int, effective: int, hp_after: int, killed: bool = False):
+    COMBAT_EVENT_BUFFER.append((current_encounter_id(), int(time.time()), kind, actor_id, actor_name,
+                                target_id, target_name, roll, base_dmg, armor, effective, hp_after, int(killed)))
+    if COMBAT_PANELS:
+        panel_note(f"{actor_name} → {target_name}: −{effective}, HP {hp_after}" + (" ☠" if killed else ""))
+    if len(COMBAT_EVENT_BUFFER) >= COMBAT_EVENT_FLUSH_SIZE:
+        flush_combat_events()
+        return
+    _schedule_combat_flush()
+
+def log_combat_events(events: List[tuple], panel_line: Optional[str] = None):
+    """
+    События одного действия по многим целям (урон по площади) — аргументы log_combat_event без encounter_id/ts.
+    Пишутся только таймером: сколько бы целей ни было, в хендлере нет ни одного commit.
+    """
+    encounter_id, ts = current_encounter_id(), int(time.time())
+    COMBAT_EVENT_BUFFER.extend((encounter_id, ts, *ev[:-1], int(ev[-1])) for ev in events)
+    if COMBAT_PANELS and panel_line:
+        panel_note(panel_line)
+    _schedule_combat_flush()
+
+def _schedule_combat_flush():
+    global _combat_flush_handle
+    if _combat_flush_handle is None:
+        try:
+            _combat_flush_handle = asyncio.get_running_loop().call_later(COMBAT_EVENT_FLUSH_DELAY, flush_combat_events)
+        except RuntimeError:  # вне event loop (CLI) — пишем сразу
+            flush_combat_events()
+
+def flush_combat_events():
+    global _combat_flush_handle
+    if _combat_flush_handle is not None:
+        _combat_flush_handle.cancel()
+        _combat_flush_handle = None
+    if not COMBAT_EVENT_BUFFER:
+        return
+    batch = COMBAT_EVENT_BUFFER[:]
+    COMBAT_EVENT_BUFFER.clear()
+    c = conn()
+    c.executemany("""
+        INSERT INTO combat_events (encounter_id, ts, kind, actor_id, actor_name, target_id, target_name,
+                                   roll, base_dmg, armor, effective, hp_after, killed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, batch)
+    c.commit()
+    c.close()
+    logger.debug("Flushed %s combat events", len(batch))
+
+def load_combat_events(encounter_id: int, after_id: int = 0, limit: int = COMBAT_EVENTS_PAGE_SIZE) -> List[tuple]:
+    flush_combat_events()
+    c = conn()
+    rows = c.execute("""
+        SELECT id, ts, kind, actor_name, target_name, roll, base_dmg, armor, effective, hp_after, killed
+        FROM combat_events WHERE encounter_id = ? AND id > ? ORDER BY id LIMIT ?
+    """, (encounter_id, after_id, limit)).fetchall()
+    c.close()
+    return rows
+
+def format_combat_event(row: tuple) -> str:
+    _id, ts, kind, actor, target, roll, base_dmg, armor, effective, hp_after, killed = row
+    when = time.strftime("%H:%M:%S", time.localtime(ts))
+    roll_part = f"d10 {roll}, " if roll is not None else ""
+    line = f"#{_id} {when} {actor} -> {target}: {roll_part}урон {base_dmg}, броня {armor} -> {effective}, HP {hp_after}"
+    return line + (" ☠" if killed else "")
+
+# ====== COMBAT PANEL ======
+# Закреплённое сообщение на столкновение: HP мобов и последние действия. События только дописываются
+# в память, а правка сообщения откладывается на PANEL_EDIT_DELAY: все удары за это окно — одна правка.
+PANEL_EDIT_DELAY = 3.0
+PANEL_LAST_ACTIONS = 6
+PANEL_MAX_ROWS = 15  # больше мобов — панель показывает группы вместо отдельных мобов
+PANEL_BAR = 10
+COMBAT_PANELS: Dict[int, Dict[str, Any]] = {}  # chat_id -> {"message_id", "encounter_id", "last", "max_hp"}
+
+def _hp_bar(hp: int, max_hp: int) -> str:
+    filled = round(PANEL_BAR * hp / max_hp) if max_hp else 0
+    return "▰" * filled + "▱" * (PANEL_BAR - filled)
+
+def panel_track_max_hp(panel: Dict[str, Any], battle: Dict[str, Any]):
+    # максимум HP у мобов не хранится — запоминаем наибольшее увиденное
+    max_hp = panel["max_hp"]
+    for npc_id, hp in zip(battle["ids"], battle["hp"]):
+        max_hp[npc_id] = max(hp, max_hp.get(npc_id, 0))
+
+def render_combat_panel(panel: Dict[str, Any]) -> str:
+    battle = load_battle()
+    panel_track_max_hp(panel, battle)
+    max_hp = panel["max_hp"]
+    lines = [f"⚔️ Столкновение #{panel['encounter_id']}"]
+    if len(battle["ids"]) <= PANEL_MAX_ROWS:
+        for npc_id, name, hp in zip(battle["ids"], battle["names"], battle["hp"]):
+            lines.append(f"{name} {_hp_bar(hp, max_hp[npc_id])} {hp}/{max_hp[npc_id]}")
+    else:
+        groups: Dict[str, List[int]] = {}
+        for npc_id, g, hp in zip(battle["ids"], battle["groups"], battle["hp"]):
+            acc = groups.setdefault(g, [0, 0, 0])
+            acc[0] += 1
+            acc[1] += hp
+            acc[2] += max_hp[npc_id]
+        for g, (n, hp, total) in groups.items():
+            lines.append(f"{g} ×{n} {_hp_bar(hp, total)} {hp}/{total}")
+    if not battle["ids"]:
+        lines.append("Мобов в бою нет.")
+    if panel["last"]:
+        lines.append("")
+        lines.append("Последние действия:")
+        lines.extend(panel["last"])
+    return "\n".join(lines)
+
+def panel_note(line: str):
+    # панели текущего столкновения получают строку; правка — одна на окно PANEL_EDIT_DELAY
+    encounter_id = current_encounter_id()
+    for chat_id, panel in COMBAT_PANELS.items():
+        if panel["encounter_id"] != encounter_id:
+            continue
+        panel["last"].append(line)
+        if ("panel", chat_id) not in TIMERS:
+            try:
+                schedule_timer(("panel", chat_id), PANEL_EDIT_DELAY, refresh_combat_panel, chat_id)
+            except RuntimeError:  # вне event loop
+                pass
+
+async def refresh_combat_panel(chat_id: int):
+    panel = COMBAT_PANELS.get(chat_id)
+    if not panel:
+        return
+    try:
+        await bot.edit_message_text(render_combat_panel(panel), chat_id=chat_id, message_id=panel["message_id"])
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            # сообщение удалено или недоступно — панель больше не ведём
+            logger.warning("Combat panel in %s dropped: %s", chat_id, e)
+            COMBAT_PANELS.pop(chat_id, None)
+
+async def open_combat_panel(chat_id: int):
+    panel = {"message_id": None, "encounter_id": current_encounter_id(), "last": deque(maxlen=PANEL_LAST_ACTIONS),
+             "max_hp": {}}
+    sent = await bot.send_message(chat_id, render_combat_panel(panel))
+    panel["message_id"] = sent.message_id
+    COMBAT_PANELS[chat_id] = panel
+    try:
+        await bot.pin_chat_message(chat_id, sent.message_id, disable_notification=True)
+    except TelegramAPIError as e:
+        logger.warning("Cannot pin combat panel in %s: %s", chat_id, e)
+
+async def combat_answer(message: Message, user_id: int, text: str):
+    # при открытой панели результат пишется в сообщение-пикер, а не новым сообщением в чат
+    if message.chat.id in COMBAT_PANELS:
+        await message.edit_text(text)
+    else:
+        await message.answer(text, reply_markup=main_menu_keyboard(user_id, message.chat.type))
+
+# ====== SCHEDULER ======
+# Один heap таймеров на весь бот. run_scheduler спит ровно до ближайшего срока (без опроса);
+# schedule_timer/cancel_timer — O(log n). Перепланирование по тому же ключу оставляет в heap
+# устаревшую запись, она отбрасывается при извлечении (seq не совпадает).
+TIMER_HEAP: List[tuple] = []           # (when, seq, key)
+TIMERS: Dict[Any, tuple] = {}          # key -> (when, seq, callback, args, interval)
+_timer_seq = itertools.count()
+_timer_wakeup: Optional[asyncio.Event] = None
+
+def schedule_timer(key, delay: float, callback, *args, interval: Optional[float] = None):
+    """
+    Запускает callback(*args) через delay секунд (и далее каждые interval, если задан).
+    Таймер с тем же key заменяется. callback может быть обычной функцией или корутиной.
+    """
+    when = asyncio.get_running_loop().time() + delay
+    seq = next(_timer_seq)
+    TIMERS[key] = (when, seq, callback, args, interval)
+    heapq.heappush(TIMER_HEAP, (when, seq, key))
+    if len(TIMER_HEAP) > 2 * len(TIMERS) + 64:
+        # слишком много устаревших записей — пересобираем heap из живых таймеров
+        TIMER_HEAP[:] = [(t[0], t[1], k) for k, t in TIMERS.items()]
+        heapq.heapify(TIMER_HEAP)
+    if _timer_wakeup is not None and TIMER_HEAP[0][1] == seq:
+        _timer_wakeup.set()  # новый таймер раньше текущего ожидания
+
+def cancel_timer(key):
+    TIMERS.pop(key, None)
+
+async def _run_timer(key, callback, args):
+    try:
+        res = callback(*args)
+        if asyncio.iscoroutine(res):
+            await res
+    except Exception:
+        logger.exception("Timer %s failed", key)
+
+async def run_scheduler():
+    global _timer_wakeup
+    _timer_wakeup = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    while True:
+        _timer_wakeup.clear()
+        while TIMER_HEAP:
+            when, seq, key = TIMER_HEAP[0]
+            timer = TIMERS.get(key)
+            if timer is None or timer[1] != seq:
+                heapq.heappop(TIMER_HEAP)
+                continue
+            if when > loop.time():
+                break
+            heapq.heappop(TIMER_HEAP)
+            _, _, callback, args, interval = timer
+            if interval:
+                new_seq = next(_timer_seq)
+                TIMERS[key] = (when + interval, new_seq, callback, args, interval)
+                heapq.heappush(TIMER_HEAP, (when + interval, new_seq, key))
+            else:
+                del TIMERS[key]
+            asyncio.create_task(_run_timer(key, callback, args))
+        timeout = TIMER_HEAP[0][0] - loop.time() if TIMER_HEAP else None
+        try:
+            await asyncio.wait_for(_timer_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+# ====== SEARCH ======
+SEARCH_FUZZY_CUTOFF = 0.6
+SEARCH_FUZZY_MAX_CANDIDATES = 2000  # сколько терминов словаря максимум сравнивается с одним словом запроса
+
+def normalize_search_text(text: str) -> List[str]:
+    return re.findall(r"\w+", text.casefold().replace("ё", "е"))
+
+def _fuzzy_terms(token: str, vocab: List[str], n: int = 5) -> List[str]:
+    # сравниваем и со словом целиком, и с его началом той же длины ("кал" ~ "кол...")
+    scored = []
+    matcher = difflib.SequenceMatcher(None, "", token)  # token — вторая последовательность, её разбор кэшируется
+    for term in vocab:
+        score = 0.0
+        for candidate in (term, term[:len(token)]):
+            matcher.set_seq1(candidate)
+            if matcher.real_quick_ratio() >= SEARCH_FUZZY_CUTOFF and matcher.quick_ratio() >= SEARCH_FUZZY_CUTOFF:
+                score = max(score, matcher.ratio())
+        if score >= SEARCH_FUZZY_CUTOFF:
+            scored.append((score, term))
+    scored.sort(reverse=True)
+    return [t for _, t in scored[:n]]
+
+def _fuzzy_candidates(c, token: str) -> List[str]:
+    # кандидаты сужаются в SQL: та же первая буква (диапазон по term, fts5vocab его использует),
+    # не короче слова запроса на 2+ символа, и не больше SEARCH_FUZZY_MAX_CANDIDATES
+    return [r[0] for r in c.execute(
+        "SELECT term FROM search_vocab WHERE term >= ? AND term < ? AND length(term) >= ? LIMIT ?",
+        (token[0], chr(ord(token[0]) + 1), len(token) - 2, SEARCH_FUZZY_MAX_CANDIDATES))]
+
+def search_names(kind: str, query: str, limit: int = 20) -> List[int]:
+    """
+    Поиск по search_index (FTS5): kind "item" или "character".
+    Сначала префиксный поиск по каждому слову, при пустом результате — нечёткий по терминам словаря
+    с той же первой буквой (опечатку в первой букве нечёткий поиск не исправляет).
+    Возвращает id (items.id / characters.user_id) по убыванию релевантности.
+    """
+    tokens = normalize_search_text(query)
+    if not tokens:
+        return []
+    sql = "SELECT ref_id FROM search_index WHERE search_index MATCH ? AND kind = ? ORDER BY rank LIMIT ?"
+    c = conn()
+    try:
+        rows = c.execute(sql, (" ".join(f'"{t}"*' for t in tokens), kind, limit)).fetchall()
+        if not rows:
+            groups = []
+            for t in tokens:
+                close = _fuzzy_terms(t, _fuzzy_candidates(c, t))
+                if not close:
+                    return []
+                groups.append("(" + " OR ".join(f'"{w}"*' for w in close) + ")")
+            rows = c.execute(sql, (" AND ".join(groups), kind, limit)).fetchall()
+    finally:
+        c.close()
+    return [r[0] for r in rows]
+
+# ====== IMPORT / EXPORT ======
+IMPORT_BATCH_SIZE = 500
+ITEM_TYPES = ("оружие", "броня", "аксессуар")
+CATALOG_ENTITIES = ("items", "stores", "npc", "templates")
+CATALOG_FORMATS = ("jsonl", "csv")
+
+def _int_field(row: Dict[str, Any], key: str, default: Optional[int] = None) -> Optional[int]:
+    val = row.get(key)
+    if val is None or val == "":
+        if default is None:
+            raise ValueError(f"поле {key} обязательно")
+        return default
+    return int(val)
+
+def _opt_int_field(row: Dict[str, Any], key: str) -> Optional[int]:
+    val = row.get(key)
+    return None if val is None or val == "" else int(val)
+
+def _attrs_field(row: Dict[str, Any], key: str) -> Dict[str, int]:
+    # jsonl: вложенный объект {"сила": 1}, csv: отдельная колонка на каждый атрибут
+    raw = row.get(key)
+    if isinstance(raw, str) and raw:
+        raw = json.loads(raw)
+    if raw is None or raw == "":
+        raw = {a: row[a] for a in ATTRIBUTES if row.get(a) not in (None, "")}
+    if not isinstance(raw, dict):
+        raise ValueError(f"поле {key} должно быть объектом")
+    unknown = [k for k in raw if k not in ATTRIBUTES]
+    if unknown:
+        raise ValueError(f"неизвестные атрибуты: {', '.join(unknown)}")
+    attrs = zero_bonus()
+    for k, v in raw.items():
+        attrs[k] = int(v)
+    return attrs
+
+def _import_item_row(row: Dict[str, Any]) -> tuple:
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise ValueError("поле name обязательно")
+    typ = (row.get("type") or "").strip().lower()
+    if typ not in ITEM_TYPES:
+        raise ValueError(f"неизвестный тип предмета: {typ}")
+    # store_id не проверяется: снаряжение NPC живёт вне магазинов (store_id 0 и т.п.)
+    store_id = _int_field(row, "store_id")
+    return (_opt_int_field(row, "id"), name, typ, _int_field(row, "damage", 0), _int_field(row, "cost"),
+            store_id, _int_field(row, "hidden", 0), _int_field(row, "armor", 0)) + attrs_to_row(_attrs_field(row, "bonus"))
+
+def _import_store_row(row: Dict[str, Any]) -> tuple:
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise ValueError("поле name обязательно")
+    return (_opt_int_field(row, "id"), name)
+
+def _import_npc_row(row: Dict[str, Any]) -> tuple:
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise ValueError("поле name обязательно")
+    return (_opt_int_field(row, "id"), name, _opt_int_field(row, "weapon_id"), _opt_int_field(row, "armor_id"),
+            _int_field(row, "hp"), _int_field(row, "in_combat", 0), _int_field(row, "damage", 0)) + attrs_to_row(_attrs_field(row, "attrs"))
+
+def _import_template_row(row: Dict[str, Any]) -> tuple:
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise ValueError("поле name обязательно")
+    # те же ограничения, что у /template
+    hp, variance = _int_field(row, "hp"), _int_field(row, "hp_variance", 0)
+    if hp <= 0:
+        raise ValueError("hp должно быть больше 0")
+    if variance < 0:
+        raise ValueError("hp_variance не может быть отрицательным")
+    return (_opt_int_field(row, "id"), name, _opt_int_field(row, "weapon_id"), _opt_int_field(row, "armor_id"),
+            hp, variance, _int_field(row, "damage", 0)) + attrs_to_row(_attrs_field(row, "attrs"))
+
+_ATTR_UPSERT = ", ".join(f"{col} = excluded.{col}" for col in ATTR_COLUMNS)
+_ATTR_PLACEHOLDERS = ", ".join("?" * len(ATTR_COLUMNS))
+
+_ITEM_PLACEHOLDERS = ", ".join(f"?{i}" for i in range(2, 9 + len(ATTR_COLUMNS)))
+
+# upsert по id; строки без id ищутся по естественному ключу: предмет — name + store_id, магазин — name,
+# шаблон — name (UNIQUE). npc без id вставляются как новые мобы.
+# active у магазинов не импортируется: активный магазин переключается только кнопкой "Магазины".
+CATALOG_IMPORT = {
+    "items": (_import_item_row, f"""
+        INSERT INTO items (id, name, type, damage, cost, store_id, hidden, armor, {ATTR_SQL})
+        VALUES (COALESCE(?1, (SELECT id FROM items WHERE name = ?2 AND store_id = ?6 ORDER BY id LIMIT 1)),
+                {_ITEM_PLACEHOLDERS})
+        ON CONFLICT(id) DO UPDATE SET name = excluded.name, type = excluded.type, damage = excluded.damage,
+            cost = excluded.cost, store_id = excluded.store_id,
+            hidden = excluded.hidden, armor = excluded.armor, {_ATTR_UPSERT}
+    """),
+    "stores": (_import_store_row, """
+        INSERT INTO stores (id, name)
+        VALUES (COALESCE(?1, (SELECT id FROM stores WHERE name = ?2 ORDER BY id LIMIT 1)), ?2)
+        ON CONFLICT(id) DO UPDATE SET name = excluded.name
+    """),
+    "npc": (_import_npc_row, f"""
+        INSERT INTO npc (id, name, weapon_id, armor_id, hp, in_combat, damage, {ATTR_SQL})
+        VALUES (?, ?, ?, ?, ?, ?, ?, {_ATTR_PLACEHOLDERS})
+        ON CONFLICT(id) DO UPDATE SET name = excluded.name, weapon_id = excluded.weapon_id,
+            armor_id = excluded.armor_id, hp = excluded.hp, in_combat = excluded.in_combat, damage = excluded.damage,
+            {_ATTR_UPSERT}
+    """),
+    "templates": (_import_template_row, f"""
+        INSERT INTO npc_templates (id, name, weapon_id, armor_id, hp, hp_variance, damage, {ATTR_SQL})
+        VALUES (?, ?, ?, ?, ?, ?, ?, {_ATTR_PLACEHOLDERS})
+        ON CONFLICT(name) DO UPDATE SET weapon_id = excluded.weapon_id,
+            armor_id = excluded.armor_id, hp = excluded.hp, hp_variance = excluded.hp_variance, damage = excluded.damage,
+            {_ATTR_UPSERT}
+    """),
+}
+
+# колонки выгрузки (атрибуты идут последними); в jsonl атрибуты — вложенный объект, в csv — колонки ATTRIBUTES
+CATALOG_EXPORT = {
+    "items": (f"SELECT id, name, type, damage, cost, store_id, hidden, armor, {ATTR_SQL} FROM items ORDER BY id",
+              ["id", "name", "type", "damage", "cost", "store_id", "hidden", "armor"], "bonus"),
+    "stores": ("SELECT id, name, active FROM stores ORDER BY id", ["id", "name", "active"], None),
+    "npc": (f"SELECT id, name, weapon_id, armor_id, hp, in_combat, damage, {ATTR_SQL} FROM npc ORDER BY id",
+            ["id", "name", "weapon_id", "armor_id", "hp", "in_combat", "damage"], "attrs"),
+    "templates": (f"SELECT {TEMPLATE_SQL} FROM npc_templates ORDER BY id",
+                  ["id", "name", "weapon_id", "armor_id", "hp", "hp_variance", "damage"], "attrs"),
+}
+
+def catalog_format_from_path(path: str) -> str:
+    return "csv" if Path(path).suffix.lower() == ".csv" else "jsonl"
+
+def _iter_raw_rows(fh, fmt: str):
+    # построчно, файл целиком в память не читается
+    if fmt == "csv":
+        for line_no, row in enumerate(csv.DictReader(fh), start=2):
+            yield line_no, row
+        return
+    for line_no, line in enumerate(fh, start=1):
+        line = line.strip()
+        if line:
+            yield line_no, line
+
+def import_catalog(entity: str, path: str, fmt: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Потоковый импорт items/stores/npc/templates из jsonl или csv.
+    Строки валидируются и пишутся пачками по IMPORT_BATCH_SIZE через executemany (upsert, см. CATALOG_IMPORT).
+    Пачка, нарушившая ограничение БД, откатывается целиком и попадает в errors, импорт продолжается.
+    """
+    normalize, sql = CATALOG_IMPORT[entity]
+    fmt = fmt or catalog_format_from_path(path)
+    c = conn()
+    cur = c.cursor()
+    imported = 0
+    errors: List[str] = []
+    error_count = 0
+    batch: List[tuple] = []
+    batch_lines: List[int] = []
+
+    def flush():
+        nonlocal imported, error_count
+        try:
+            cur.executemany(sql, batch)
+            c.commit()
+            imported += len(batch)
+        except sqlite3.IntegrityError as e:
+            c.rollback()
+            error_count += len(batch)
+            if len(errors) < 20:
+                errors.append(f"строки {batch_lines[0]}-{batch_lines[-1]}: {e}")
+        batch.clear()
+        batch_lines.clear()
+
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as fh:
+            for line_no, raw in _iter_raw_rows(fh, fmt):
+                try:
+                    row = json.loads(raw) if fmt == "jsonl" else raw
+                    if not isinstance(row, dict):
+                        raise ValueError("ожидается объект")
+                    batch.append(normalize(row))
+                    batch_lines.append(line_no)
+                except (ValueError, TypeError) as e:
+                    error_count += 1
+                    if len(errors) < 20:
+                        errors.append(f"строка {line_no}: {e}")
+                    continue
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+            if batch:
+                flush()
+    finally:
+        c.close()
+        if imported:
+            bump_render_version("catalog")
+    logger.info("Imported %s %s rows from %s (%s invalid)", imported, entity, path, error_count)
+    return {"imported": imported, "error_count": error_count, "errors": errors}
+
+def export_catalog(entity: str, path: str, fmt: str = "jsonl") -> int:
+    sql, columns, attrs_col = CATALOG_EXPORT[entity]
+    c = conn()
+    cur = c.cursor()
+    count = 0
+    try:
+        with open(path, "w", encoding="utf-8", newline="") as fh:
+            if fmt == "csv":
+                writer = csv.writer(fh)
+                writer.writerow(columns + (ATTRIBUTES if attrs_col else []))
+            for r in cur.execute(sql):
+                if fmt == "csv":
+                    writer.writerow(r)
+                else:
+                    row = dict(zip(columns, r))
+                    if attrs_col:
+                        row[attrs_col] = attrs_from_row(r[len(columns):])
+                    fh.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+    finally:
+        c.close()
+    logger.info("Exported %s %s rows to %s", count, entity, path)
+    return count
+
+def format_import_result(entity: str, res: Dict[str, Any]) -> str:
+    lines = [f"Импорт {entity}: загружено {res['imported']}, ошибок {res['error_count']}."]
+    lines += res["errors"]
+    if res["error_count"] > len(res["errors"]):
+        lines.append("…")
+    return "\n".join(lines)
 
 # ====== UI utils ======
 def chunked_list(lst: List, n: int) -> List[List]:
@@ -525,23 +1747,27 @@ def make_keyboard_from_options(options: List[str], cols: int = 2) -> ReplyKeyboa
     rows = chunked_list([KeyboardButton(text=o) for o in options], cols)
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=True)
 
-def make_keyboard_numbers(max_n: int, min_n: int = 0) -> ReplyKeyboardMarkup:
-    nums = [str(i) for i in range(min_n, max_n + 1)]
-    if not nums:
-        nums = ["0"]
-    count = len(nums)
-    cols = max(1, ceil(count / 2))
+def render_allocator(session: Dict[str, Any]) -> tuple:
+    # одно сообщение на всё распределение: текст + inline-кнопки −/+ по каждому атрибуту
+    bonuses = RACE_BONUSES[session["race"]]
+    text = (f"Распределите {ALLOC_POINTS} очков между атрибутами (раса {session['race']}, класс {session['class']}).\n"
+            f"Осталось: {session['remaining']}")
     rows = []
-    for i in range(0, count, cols):
-        row = [KeyboardButton(text=n) for n in nums[i:i+cols]]
-        rows.append(row)
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=True)
-
-def main_menu_keyboard(user_id: int, chat_type: str) -> ReplyKeyboardMarkup:
+    for i, a in enumerate(ATTRIBUTES):
+        bonus = f" ({bonuses[a]:+d})" if bonuses.get(a) else ""
+        rows.append([InlineKeyboardButton(text="−", callback_data=f"al:-:{i}"),
+                     InlineKeyboardButton(text=f"{a}: {session['allocs'][a]}{bonus}", callback_data="al:noop"),
+                     InlineKeyboardButton(text="+", callback_data=f"al:+:{i}")])
+    rows.append([InlineKeyboardButton(text="Сброс", callback_data="al:reset"),
+                 InlineKeyboardButton(text="Готово ✅", callback_data="al:ok")])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+def main_menu_keyboard(user_id: int, chat_type: str, has_character: Optional[bool] = None) -> ReplyKeyboardMarkup:
     base = []
     if chat_type == "private":
-        char = load_character_full(user_id)
-        if char:
+        if has_character is None:
+            has_character = load_character_full(user_id) is not None
+        if has_character:
             base.append(KeyboardButton(text="Пересоздать персонажа"))
         else:
             base.append(KeyboardButton(text="Создать персонажа"))
@@ -565,6 +1791,78 @@ def main_menu_keyboard(user_id: int, chat_type: str) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=False)
 
 
+# ---------- paginated inline pickers ----------
+PAGE_SIZE = 8
+
+# kind -> (SELECT id + поля для подписи, ключ keyset-пагинации, подпись кнопки)
+PICKERS = {
+    "players": ("SELECT user_id, username FROM characters WHERE 1 = 1", "user_id",
+                lambda r: f"{r[1]} ({r[0]})"),
+    "target": ("SELECT user_id, username FROM characters WHERE 1 = 1", "user_id",
+               lambda r: f"{r[1]} ({r[0]})"),
+    "trade": ("SELECT id, name, cost FROM items WHERE hidden = 0 AND store_id IN (SELECT id FROM stores WHERE active = 1)", "id",
+              lambda r: f"{r[1]} ({r[2]}g)"),
+    # мобы сгруппированы: одна кнопка «гоблин ×20» на группу, id — первый моб группы
+    "mobs": (f"SELECT * FROM (SELECT min(id) AS id, {NPC_GROUP_SQL}, count(*), min(name) FROM npc WHERE in_combat = 1 "
+             f"GROUP BY {NPC_GROUP_SQL}) WHERE 1 = 1", "id", lambda r: r[3] if r[2] == 1 else f"{r[1]} ×{r[2]}"),
+    "attack": (f"SELECT * FROM (SELECT min(id) AS id, {NPC_GROUP_SQL}, count(*), min(name) FROM npc WHERE in_combat = 1 "
+               f"GROUP BY {NPC_GROUP_SQL}) WHERE 1 = 1", "id", lambda r: r[3] if r[2] == 1 else f"{r[1]} ×{r[2]}"),
+}
+
+def fetch_picker_page(kind: str, cursor: Optional[int] = None, direction: str = "n"):
+    """
+    Keyset-страница для пикера: (rows [(id, label)], has_prev, has_next).
+    direction "n" — записи после cursor, "p" — записи перед cursor.
+    """
+    base_sql, key, label = PICKERS[kind]
+    c = conn()
+    cur = c.cursor()
+    if direction == "p":
+        cur.execute(f"{base_sql} AND {key} < ? ORDER BY {key} DESC LIMIT ?", (cursor, PAGE_SIZE + 1))
+        rows = cur.fetchall()
+        has_prev, has_next = len(rows) > PAGE_SIZE, True
+        rows = rows[:PAGE_SIZE][::-1]
+    else:
+        if cursor is None:
+            cur.execute(f"{base_sql} ORDER BY {key} LIMIT ?", (PAGE_SIZE + 1,))
+        else:
+            cur.execute(f"{base_sql} AND {key} > ? ORDER BY {key} LIMIT ?", (cursor, PAGE_SIZE + 1))
+        rows = cur.fetchall()
+        has_prev, has_next = cursor is not None, len(rows) > PAGE_SIZE
+        rows = rows[:PAGE_SIZE]
+    c.close()
+    return [(r[0], label(r)) for r in rows], has_prev, has_next
+
+# kind пикера -> kind в search_index (мобы в поиск не входят)
+PICKER_SEARCH_KINDS = {"players": "character", "target": "character", "trade": "item"}
+
+def search_picker(kind: str, query: str) -> List:
+    """Ранжированные совпадения для пикера с учётом его фильтров (активный магазин, hidden)."""
+    ids = search_names(PICKER_SEARCH_KINDS[kind], query, limit=PAGE_SIZE * 4)
+    if not ids:
+        return []
+    base_sql, key, label = PICKERS[kind]
+    c = conn()
+    rows = c.execute(f"{base_sql} AND {key} IN ({','.join('?' * len(ids))})", ids).fetchall()
+    c.close()
+    order = {_id: i for i, _id in enumerate(ids)}
+    rows.sort(key=lambda r: order[r[0]])
+    return [(r[0], label(r)) for r in rows[:PAGE_SIZE]]
+
+def make_picker_keyboard(kind: str, rows: List, has_prev: bool, has_next: bool, cols: int = 2) -> InlineKeyboardMarkup:
+    buttons = [InlineKeyboardButton(text=lbl, callback_data=f"pk:{kind}:{_id}") for _id, lbl in rows]
+    keyboard = chunked_list(buttons, cols)
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="◀", callback_data=f"pg:{kind}:p:{rows[0][0]}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="▶", callback_data=f"pg:{kind}:n:{rows[-1][0]}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(text="Отмена", callback_data=f"pk:{kind}:cancel")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
 # ====== SESSIONS ======
 CREATION_SESSIONS: Dict[int, Dict[str, Any]] = {}
 EQUIP_SESSIONS: Dict[int, Dict[str, Any]] = {}
@@ -573,9 +1871,201 @@ COMBAT_SESSIONS: Dict[int, Dict[str, Any]] = {}
 GM_COMBAT_SESSIONS: Dict[int, Dict[str, Any]] = {}
 
 # ====== Aiogram init ======
-bot = Bot(token=TOKEN)
+def make_bot(token: str, api_url: Optional[str] = None) -> Bot:
+    if api_url:
+        return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    return Bot(token=token)
+
+bot = make_bot(TOKEN, TELEGRAM_API_URL) if TOKEN else None
 dp = Dispatcher()
 
+# ====== ANTI-FLOOD ======
+# Token bucket на (пользователь, действие) для кнопок в группе. Работает до очереди пользователя
+# и до любых обращений к БД: лишние нажатия просто отбрасываются.
+FLOOD_RATES: Dict[str, tuple] = {
+    "attack": (FLOOD_RATE, FLOOD_BURST),  # «Урон» / /attack
+    "hit": (FLOOD_RATE, FLOOD_BURST),     # выбор цели атаки
+    "check": (FLOOD_RATE, FLOOD_BURST),   # бросок атрибута
+}
+# (user_id, action) -> [tokens, last_time]; порядок — по последнему нажатию, сверх FLOOD_BUCKETS_MAX
+# выбрасываются самые давние (за это время их ведро скорее всего снова полное)
+FLOOD_BUCKETS: "OrderedDict[tuple, list]" = OrderedDict()
+FLOOD_REJECTED: Dict[str, int] = {a: 0 for a in FLOOD_RATES}
+FLOOD_BUCKETS_MAX = 10000
+
+def flood_action(event) -> Optional[str]:
+    if event.message and event.message.chat.type in ("group", "supergroup"):
+        text = (event.message.text or "").strip()
+        if text == "Урон" or text.split("@")[0] == "/attack":
+            return "attack"
+        if text in ATTRIBUTES:
+            return "check"
+    if event.callback_query and (event.callback_query.data or "").startswith("pk:attack:"):
+        return "hit"
+    return None
+
+def flood_allow(user_id: int, action: str) -> bool:
+    rate, burst = FLOOD_RATES[action]
+    now = time.monotonic()
+    bucket = FLOOD_BUCKETS.get((user_id, action))
+    if bucket is None:
+        while len(FLOOD_BUCKETS) >= FLOOD_BUCKETS_MAX:
+            FLOOD_BUCKETS.popitem(last=False)
+        bucket = FLOOD_BUCKETS[(user_id, action)] = [burst, now]
+    else:
+        FLOOD_BUCKETS.move_to_end((user_id, action))
+    tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens < 1:
+        bucket[0] = tokens
+        FLOOD_REJECTED[action] += 1
+        return False
+    bucket[0] = tokens - 1
+    return True
+
+@dp.update.outer_middleware()
+async def anti_flood_middleware(handler, event, data):
+    user = data.get("event_from_user")
+    action = flood_action(event) if user and user.id != ADMIN_ID else None
+    if action and not flood_allow(user.id, action):
+        if event.callback_query:
+            await event.callback_query.answer("Слишком часто, подождите.")
+        return None
+    return await handler(event, data)
+
+# ====== PER-USER ORDERING ======
+# aiogram обрабатывает апдейты параллельно, а сессии меняются между await'ами.
+# Апдейты одного пользователя выполняются строго по очереди (asyncio.Lock честный, FIFO),
+# разные пользователи — параллельно. Запись удаляется, как только очередь пользователя пуста.
+USER_QUEUES: Dict[int, list] = {}  # user_id -> [lock, сколько апдейтов в работе/ожидании]
+
+@dp.update.outer_middleware()
+async def user_order_middleware(handler, event, data):
+    user = data.get("event_from_user")
+    if user is None:
+        return await handler(event, data)
+    slot = USER_QUEUES.get(user.id)
+    if slot is None:
+        slot = USER_QUEUES[user.id] = [asyncio.Lock(), 0]
+    if slot[1] >= USER_QUEUE_LIMIT:
+        logger.warning("Update %s from %s dropped: queue is full", event.update_id, user.id)
+        if event.callback_query:
+            await event.callback_query.answer("Подождите, предыдущие действия ещё выполняются.")
+        return None
+    slot[1] += 1
+    MAINT_STATE["last_update"] = time.monotonic()
+    try:
+        async with slot[0]:
+            return await handler(event, data)
+    finally:
+        slot[1] -= 1
+        if slot[1] == 0:
+            USER_QUEUES.pop(user.id, None)
+
+# ====== PROFILER ======
+# cProfile вокруг хендлера (universal_handler, cmd_*, коллбеки). В режиме slow профилируется каждый
+# апдейт, но сохраняются только медленные; в режиме sample — случайная доля апдейтов.
+# Профилировщик один на поток, поэтому одновременно профилируется один апдейт, а в профиль попадает
+# и то, что event loop выполнял между его await'ами — для поиска блокирующего кода это как раз полезно.
+PROFILE_SETTINGS: Dict[str, Any] = {"mode": PROFILE_MODE, "slow_ms": PROFILE_SLOW_MS, "rate": PROFILE_SAMPLE_RATE}
+PROFILE_KEEP = 20
+PROFILE_STATS_LINES = 40
+PROFILES: List[tuple] = []  # min-heap (секунды, seq, маршрут, update_id, время, текст статистики)
+_profile_seq = itertools.count()
+_profile_busy = False
+
+def profile_route(event, data) -> str:
+    handler = data.get("handler")
+    name = getattr(getattr(handler, "callback", None), "__name__", "?")
+    if isinstance(event, CallbackQuery):
+        name += "(" + ":".join((event.data or "").split(":")[:2]) + ")"
+    return name
+
+def keep_profile(elapsed: float, route: str, update_id: Optional[int], profiler: cProfile.Profile):
+    if len(PROFILES) >= PROFILE_KEEP and elapsed <= PROFILES[0][0]:
+        return  # не медленнее уже сохранённых — не тратим время на форматирование
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_STATS_LINES)
+    entry = (elapsed, next(_profile_seq), route, update_id, int(time.time()), out.getvalue())
+    if len(PROFILES) >= PROFILE_KEEP:
+        heapq.heapreplace(PROFILES, entry)
+    else:
+        heapq.heappush(PROFILES, entry)
+
+def profiles_report() -> str:
+    parts = []
+    for elapsed, _, route, update_id, ts, text in sorted(PROFILES, reverse=True):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+        parts.append(f"===== {route} | update {update_id} | {elapsed * 1000:.1f} мс | {stamp} =====\n{text}")
+    return "\n".join(parts)
+
+async def profile_middleware(handler, event, data):
+    global _profile_busy
+    mode = PROFILE_SETTINGS["mode"]
+    if mode == "off" or _profile_busy or (mode == "sample" and random.random() >= PROFILE_SETTINGS["rate"]):
+        return await handler(event, data)
+    _profile_busy = True
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        return await handler(event, data)
+    finally:
+        profiler.disable()
+        _profile_busy = False
+        elapsed = time.perf_counter() - start
+        if mode == "sample" or elapsed * 1000 >= PROFILE_SETTINGS["slow_ms"]:
+            update = data.get("event_update")
+            keep_profile(elapsed, profile_route(event, data), update.update_id if update else None, profiler)
+
+dp.message.middleware(profile_middleware)
+dp.callback_query.middleware(profile_middleware)
+
+# ====== LOOP WATCHDOG ======
+# Корутина раз в LAG_CHECK_INTERVAL отмечает «пульс» и меряет, насколько позже заказанного проснулась.
+# Отдельный поток следит за пульсом: если цикл молчит дольше LAG_THRESHOLD_MS, он снимает стек потока
+# цикла прямо во время блокировки и пишет в лог, какая функция main.py выполнялась.
+LAG_CHECK_INTERVAL = 0.1
+LAG_SAMPLES: deque = deque(maxlen=6000)  # задержки планирования, мс (последние ~10 минут)
+LAG_STALLS: deque = deque(maxlen=20)     # (время, мс, функция main.py, стек)
+LAG_STACK_DEPTH = 8
+_lag_state: Dict[str, Any] = {"beat": 0.0, "thread": None, "stop": threading.Event()}
+
+def blocked_frame_summary(thread_id: int) -> tuple:
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return "?", ""
+    stack = traceback.extract_stack(frame)
+    ours = [f for f in stack if f.filename == __file__]
+    where = f"{ours[-1].name}:{ours[-1].lineno}" if ours else "?"
+    return where, "".join(traceback.format_list(stack[-LAG_STACK_DEPTH:]))
+
+def lag_watchdog_thread():
+    reported = None
+    stop = _lag_state["stop"]
+    while not stop.wait(LAG_CHECK_INTERVAL):
+        beat = _lag_state["beat"]
+        stalled_ms = (time.monotonic() - beat - LAG_CHECK_INTERVAL) * 1000
+        if stalled_ms < LAG_THRESHOLD_MS or beat == reported:
+            continue
+        reported = beat  # одна запись на одну остановку
+        where, stack = blocked_frame_summary(_lag_state["thread"])
+        LAG_STALLS.append((int(time.time()), round(stalled_ms), where, stack))
+        logger.warning("Event loop blocked for %.0f ms in %s\n%s", stalled_ms, where, stack)
+
+async def loop_lag_monitor():
+    _lag_state["thread"] = threading.get_ident()
+    _lag_state["beat"] = time.monotonic()
+    _lag_state["stop"].clear()
+    threading.Thread(target=lag_watchdog_thread, name="lag-watchdog", daemon=True).start()
+    try:
+        while True:
+            start = _lag_state["beat"] = time.monotonic()
+            await asyncio.sleep(LAG_CHECK_INTERVAL)
+            LAG_SAMPLES.append(max(0.0, time.monotonic() - start - LAG_CHECK_INTERVAL) * 1000)
+    finally:
+        _lag_state["stop"].set()
+
 # ====== COMMANDS ======
 @dp.message(Command(commands=["start"]))
 async def cmd_start(message: Message):
@@ -604,11 +2094,18 @@ async def cmd_create(message: Message):
 
 @dp.message(Command(commands=["show"]))
 async def cmd_show(message: Message):
-    char = load_character_full(message.from_user.id)
-    if not char:
-        await message.answer("Персонаж не найден. Создайте: /create", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-        return
+    user_id = message.from_user.id
+    text = get_cached_render(("character", user_id))
+    if text is None:
+        char = load_character_full(user_id)
+        if not char:
+            await message.answer("Персонаж не найден. Создайте: /create", reply_markup=main_menu_keyboard(user_id,message.chat.type))
+            return
+        text = render_character_sheet(char)
+        put_cached_render(("character", user_id), text)
+    await message.answer(text, reply_markup=main_menu_keyboard(user_id, message.chat.type, has_character=True))
 
+def render_character_sheet(char: Dict[str, Any]) -> str:
     weapon_name = char.get("weapon")
     weapon_dmg = char.get("weapon_damage")
     armor_name = char.get("armor")
@@ -643,7 +2140,7 @@ async def cmd_show(message: Message):
 
     inv = char.get('inventory_names') or []
     lines.append("Инвентарь: " + (", ".join(inv) if inv else "-"))
-    await message.answer("\n".join(lines), reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+    return "\n".join(lines)
 
 @dp.message(Command(commands=["shop"]))
 async def cmd_shop(message: Message):
@@ -651,10 +2148,16 @@ async def cmd_shop(message: Message):
         await message.answer("Магазин сейчас закрыт.",
                        reply_markup=main_menu_keyboard(message.from_user.id, message.chat.type))
         return
+    text = get_cached_render("shop")
+    if text is None:
+        text = render_shop_listing()
+        put_cached_render("shop", text)
+    await message.answer(text, reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+
+def render_shop_listing() -> str:
     active = get_active_store()
     if not active:
-        await message.answer("Магазин не активен. Обратитесь к администратору.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-        return
+        return "Магазин не активен. Обратитесь к администратору."
     items = get_all_items_active_store()
     weapons = [i["name"] for i in items if i["type"] == "оружие"]
     armors = [i["name"] for i in items if i["type"] in ("броня","аксессуар")]
@@ -666,7 +2169,7 @@ async def cmd_shop(message: Message):
     if armors:
         msg.append("\nБроня/Аксессуары:")
         msg += [f"• {n}" for n in armors]
-    await message.answer("\n".join(msg), reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+    return "\n".join(msg)
 
 @dp.message(Command(commands=["equip"]))
 async def cmd_equip(message: Message):
@@ -684,14 +2187,13 @@ async def cmd_equip(message: Message):
 @dp.message(Command(commands=["attack"]))
 async def cmd_attack(message: Message):
     user_id = message.from_user.id
-    npcs = get_npcs_in_combat()
-    if not npcs:
+    rows, has_prev, has_next = fetch_picker_page("attack")
+    if not rows:
         await message.answer("Сейчас нет мобов в бою.", reply_markup=main_menu_keyboard(user_id,message.chat.type))
         return
-    names = [n["name"] for n in npcs]
-    # сохраним мап в сессии для дальнейшего выбора
-    COMBAT_SESSIONS[user_id] = {"step": "player_choose_npc", "npcs": {n["name"]: n["id"] for n in npcs}}
-    await message.answer("Выберите моба, которому нанеcёте урон:", reply_markup=make_keyboard_from_options(names, cols=2))
+    # в сессии только шаг; позиция страницы живёт в callback_data кнопок ◀ ▶, выбор приходит callback'ом
+    COMBAT_SESSIONS[user_id] = {"step": "player_choose_npc"}
+    await message.answer("Выберите моба, которому нанеcёте урон:", reply_markup=make_picker_keyboard("attack", rows, has_prev, has_next))
     return
 
 @dp.message(Command(commands=["list"]))
@@ -700,25 +2202,1047 @@ async def cmd_list(message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
         return
-    all_chars = load_all_characters()
-    if not all_chars:
-        await message.answer("Персонажей нет.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-        return
+    # фильтры: /list эльф вор (раса и/или класс в любом порядке)
+    args = (message.text or "").split()[1:] if (message.text or "").startswith("/") else []
+    race = next((a.lower() for a in args if a.lower() in RACE_BONUSES), None)
+    cls = next((a.lower() for a in args if a.lower() in CLASSES), None)
+    kb = main_menu_keyboard(message.from_user.id, message.chat.type)
+    sent = 0
+    # каждая страница рендерится и отправляется сразу, в памяти только одна страница
+    for page in iter_character_list_pages(race=race, cls=cls):
+        lines = [
+            f"@{username}: "
+            f"{c_race} / {c_cls} — "
+            f"урон оружия: {weapon_damage}, броня: {armor_value}"
+            for _id, username, c_race, c_cls, weapon_damage, armor_value in page
+        ]
+        await message.answer("\n".join(lines), reply_markup=kb)
+        sent += 1
+    if not sent:
+        await message.answer("Персонажей нет.", reply_markup=kb)
+
+@dp.message(Command(commands=["top"]))
+async def cmd_top(message: Message):
+    # /top — все таблицы по 5 мест, /top kills — одна таблица на 10 мест
+    args = (message.text or "").split()[1:]
+    stats = [args[0]] if args and args[0] in STAT_LABELS else STAT_COLUMNS
+    limit = 10 if len(stats) == 1 else 5
+    totals = load_campaign_stats()
     lines = []
-    for c in all_chars:
-        weapon_name = c['weapon_name'] or "-"
-        armor_name = c['armor_name'] or "-"
-        lines.append(
-            f"@{c['username']}: "
-            f"{c['race']} / {c['class']} — "
-            f"урон оружия: {c['weapon_damage']}, броня: {c['armor_value']}"
-        )
-    # отправляем по кускам, если много
-    chunk_size = 40
-    for i in range(0, len(lines), chunk_size):
-        await message.answer("\n".join(lines[i:i+chunk_size]), reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-
-# ====== UNIVERSAL HANDLER (creation, equip, equip choose_item, GM flows, etc.) ======
+    for stat in stats:
+        lines.append(f"{STAT_LABELS[stat]} (всего {totals.get(stat, 0)}):")
+        board = load_leaderboard(stat, limit)
+        lines += [f"  {i}. {name} — {val}" for i, (name, val) in enumerate(board, 1)] or ["  -"]
+    await message.answer("\n".join(lines), reply_markup=main_menu_keyboard(message.from_user.id, message.chat.type))
+
+@dp.message(Command(commands=["export"]))
+async def cmd_export(message: Message):
+    user_id = message.from_user.id
+    if user_id != ADMIN_ID or message.chat.type != "private":
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(user_id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    entity = args[0].lower() if args else ""
+    fmt = args[1].lower() if len(args) > 1 else "jsonl"
+    if entity not in CATALOG_ENTITIES or fmt not in CATALOG_FORMATS:
+        await message.answer(f"Использование: /export <{'|'.join(CATALOG_ENTITIES)}> [{'|'.join(CATALOG_FORMATS)}]")
+        return
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export_catalog, entity, path, fmt)
+        await message.answer_document(FSInputFile(path, filename=f"{entity}.{fmt}"), caption=f"{entity}: {count} строк")
+    finally:
+        os.remove(path)
+
+@dp.message(Command(commands=["encounter"]))
+async def cmd_encounter(message: Message):
+    # новый номер столкновения: последующие события боя пишутся под ним
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    flush_combat_events()
+    new_id = current_encounter_id() + 1
+    set_flag("encounter_id", new_id)
+    await message.answer(f"Начато столкновение #{new_id}.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+    if message.chat.type in ("group", "supergroup"):
+        await open_combat_panel(message.chat.id)
+
+@dp.message(Command(commands=["panel"]))
+async def cmd_panel(message: Message):
+    # /panel — новая закреплённая панель текущего столкновения в этой группе; /panel off — перестать её вести
+    if message.from_user.id != ADMIN_ID or message.chat.type not in ("group", "supergroup"):
+        await message.answer("Команда доступна администратору в группе.")
+        return
+    if (message.text or "").split()[1:2] == ["off"]:
+        COMBAT_PANELS.pop(message.chat.id, None)
+        cancel_timer(("panel", message.chat.id))
+        await message.answer("Панель боя отключена.")
+        return
+    await open_combat_panel(message.chat.id)
+
+TEMPLATE_OPTIONS = {"hp": "hp", "dmg": "damage", "var": "hp_variance", "weapon": "weapon_id", "armor": "armor_id"}
+
+@dp.message(Command(commands=["template"]))
+async def cmd_template(message: Message):
+    # /template — список; /template гоблин hp=12 dmg=1 var=3 [weapon=<id>] [armor=<id>] — создать/обновить
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    if not args:
+        templates = list_npc_templates()
+        lines = [f"{t['id']}. {t['name']}: HP {t['hp']}±{t['hp_variance']}, урон +{t['damage']}" for t in templates]
+        await message.answer("Шаблоны мобов:\n" + "\n".join(lines) if lines else "Шаблонов нет. /template <имя> hp=<число> [dmg=] [var=]")
+        return
+    name = " ".join(a for a in args if "=" not in a)
+    opts: Dict[str, Optional[int]] = {}
+    try:
+        for a in args:
+            if "=" in a:
+                key, val = a.split("=", 1)
+                opts[TEMPLATE_OPTIONS[key.lower()]] = int(val)
+    except (KeyError, ValueError):
+        opts = {}
+    if not name or "hp" not in opts or opts["hp"] <= 0 or opts.get("hp_variance", 0) < 0:
+        await message.answer("Использование: /template <имя> hp=<число> [dmg=<число>] [var=<разброс HP>] [weapon=<id>] [armor=<id>]")
+        return
+    save_npc_template(name, **opts)
+    await message.answer(f"Шаблон «{name}» сохранён. Призвать: /spawn {name} <количество>")
+
+@dp.message(Command(commands=["spawn"]))
+async def cmd_spawn(message: Message):
+    # /spawn гоблин 20 [разброс HP] — 20 пронумерованных гоблинов сразу в бою
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    numbers = []
+    while args and args[-1].isdigit() and len(numbers) < 2:
+        numbers.insert(0, int(args.pop()))
+    template = get_npc_template(" ".join(args)) if args else None
+    if not template or not numbers or not 1 <= numbers[0] <= SPAWN_MAX:
+        await message.answer(f"Использование: /spawn <шаблон> <количество 1..{SPAWN_MAX}> [разброс HP]")
+        return
+    names = spawn_npcs(template, numbers[0], numbers[1] if len(numbers) > 1 else None)
+    shown = ", ".join(names) if len(names) <= 5 else f"{names[0]} … {names[-1]}"
+    if COMBAT_PANELS:
+        battle = load_battle()
+        for panel in COMBAT_PANELS.values():
+            panel_track_max_hp(panel, battle)
+        panel_note(f"В бой вступают {len(names)}: {shown}")
+    await message.answer(f"В бой вступают {len(names)}: {shown}.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+
+@dp.message(Command(commands=["aoe"]))
+async def cmd_aoe(message: Message):
+    # /aoe 8 [гоблин] — урон 8 по всем мобам в бою (или по группе), броня каждого вычитается
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer("Использование: /aoe <урон> [группа мобов]")
+        return
+    dmg, group = int(args[0]), " ".join(args[1:]) or None
+    battle = load_battle(group)
+    if not battle["ids"]:
+        await message.answer("Некого задеть: мобов в бою нет.")
+        return
+    res = aoe_damage(battle, dmg)
+    lines = [f"💥 Урон {dmg} по {len(battle['ids'])} мобам: задето {res['hit']}, всего снято {res['damage']} HP."]
+    if res["killed"]:
+        shown = ", ".join(res["killed"][:10]) + (" …" if len(res["killed"]) > 10 else "")
+        lines.append(f"Погибли ({len(res['killed'])}): {shown}")
+    lines += battle_summary(battle)
+    await message.answer("\n".join(lines), reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+
+@dp.message(Command(commands=["sim"]))
+async def cmd_sim(message: Message):
+    # /sim гоблин [user_id] — 100k боёв персонажа (по умолчанию своего) против моба/шаблона
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    user_id = message.from_user.id
+    if len(args) > 1 and args[-1].isdigit():
+        user_id = int(args.pop())
+    npc = resolve_sim_npc(" ".join(args)) if args else None
+    char = load_character_full(user_id)
+    if not npc or not char:
+        await message.answer("Использование: /sim <id моба или шаблон> [user_id игрока]. Нужны моб/шаблон и персонаж.")
+        return
+    player = sim_player_from_character(char)
+    res = await asyncio.to_thread(simulate_encounter, player, npc)
+    await message.answer(format_simulation(player, npc, res))
+
+@dp.message(Command(commands=["events"]))
+async def cmd_events(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав для выполнения этой команды.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        encounter_id = int(args[0]) if args else current_encounter_id()
+    except ValueError:
+        await message.answer("Использование: /events [номер столкновения]")
+        return
+    await send_combat_events_page(message, encounter_id, 0)
+
+async def send_combat_events_page(message: Message, encounter_id: int, after_id: int):
+    rows = load_combat_events(encounter_id, after_id, COMBAT_EVENTS_PAGE_SIZE + 1)
+    if not rows:
+        await message.answer(f"В столкновении #{encounter_id} событий нет.")
+        return
+    page = rows[:COMBAT_EVENTS_PAGE_SIZE]
+    kb = None
+    if len(rows) > COMBAT_EVENTS_PAGE_SIZE:
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="▶ Дальше", callback_data=f"ev:{encounter_id}:{page[-1][0]}")]])
+    await message.answer(f"Столкновение #{encounter_id}:\n" + "\n".join(format_combat_event(r) for r in page), reply_markup=kb)
+
+@dp.message(Command(commands=["grant"]))
+async def cmd_grant(message: Message):
+    # /grant gold 50 | /grant heal 10 | /grant heal full | /grant item Кольчужная рубаха
+    # после — необязательные фильтры: раса, класс, «живые»
+    kb = main_menu_keyboard(message.from_user.id, message.chat.type)
+    if message.from_user.id != ADMIN_ID or message.chat.type != "private":
+        await message.answer("Команда доступна администратору в личке.", reply_markup=kb)
+        return
+    args = (message.text or "").split()[1:]
+    usage = ("Использование:\n/grant gold <число> [раса] [класс] [живые]\n"
+             "/grant heal <число|full> [фильтры]\n/grant item <название или id> [фильтры]")
+    if not args or args[0].lower() not in GRANT_KINDS:
+        await message.answer(usage, reply_markup=kb)
+        return
+    kind, rest = args[0].lower(), args[1:]
+    race = next((a.lower() for a in rest if a.lower() in RACE_BONUSES), None)
+    cls = next((a.lower() for a in rest if a.lower() in CLASSES), None)
+    alive_only = any(a.lower() == "живые" for a in rest)
+    value = [a for a in rest if a.lower() not in RACE_BONUSES and a.lower() not in CLASSES and a.lower() != "живые"]
+    amount, item = None, None
+    if kind == "item":
+        query = " ".join(value)
+        item = get_item_by_id(int(query)) if query.isdigit() else get_item_by_name(query)
+        if not item and query:
+            found = search_names("item", query, 1)
+            item = get_item_by_id(found[0]) if found else None
+        if not item:
+            await message.answer("Предмет не найден.", reply_markup=kb)
+            return
+    elif kind == "heal" and value == ["full"]:
+        amount = None
+    else:
+        try:
+            amount = int(value[0]) if len(value) == 1 else None
+        except ValueError:
+            amount = None
+        if amount is None or (kind == "heal" and amount <= 0):
+            await message.answer(usage, reply_markup=kb)
+            return
+    res = bulk_grant(kind, amount, item, race, cls, alive_only)
+    if kind == "gold":
+        what = f"{amount:+d} золота"
+    elif kind == "heal":
+        what = "Полное лечение" if amount is None else f"+{amount} HP"
+    else:
+        what = f"{item['name']} за {item['cost']}g"
+    text = f"{what}: изменено персонажей — {res['changed']}."
+    if res["skipped"]:
+        text += f"\nНе хватило золота ({len(res['skipped'])}): " + ", ".join(res["skipped"][:30])
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("ev:"))
+async def combat_events_callback(callback: CallbackQuery):
+    try:
+        if callback.from_user.id != ADMIN_ID or not callback.message:
+            await callback.answer()
+            return
+        _, encounter_id, after_id = callback.data.split(":")
+        await callback.answer()
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await send_combat_events_page(callback.message, int(encounter_id), int(after_id))
+    except Exception:
+        logger.exception("Exception in combat_events_callback")
+
+async def handle_catalog_upload(message: Message):
+    # подпись документа (items/stores/npc/templates) или имя файла (items.jsonl) задают что импортируем
+    doc = message.document
+    file_name = doc.file_name or ""
+    caption = (message.caption or "").strip().lower()
+    entity = caption.split()[0] if caption else Path(file_name).stem.lower()
+    if entity not in CATALOG_ENTITIES:
+        await message.answer(f"Укажите в подписи к файлу, что импортировать: {', '.join(CATALOG_ENTITIES)}.")
+        return
+    fmt = catalog_format_from_path(file_name)
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        await message.bot.download(doc, destination=path)
+        res = await asyncio.to_thread(import_catalog, entity, path, fmt)
+    finally:
+        os.remove(path)
+    await message.answer(format_import_result(entity, res), reply_markup=main_menu_keyboard(message.from_user.id, message.chat.type))
+
+# ====== PICKER CALLBACKS ======
+# kind -> (словарь сессий, шаг, на котором ждём выбор)
+PICKER_SESSIONS = {
+    "attack": (COMBAT_SESSIONS, "player_choose_npc"),
+    "mobs": (GM_COMBAT_SESSIONS, "admin_choose_npc"),
+    "target": (GM_COMBAT_SESSIONS, "admin_npc_choose_player"),
+    "players": (GM_SESSIONS, "choose_player"),
+    "trade": (GM_SESSIONS, "gm_trade_choose"),
+}
+
+async def pick_attack(message: Message, user_id: int, npc_id: int):
+    if message.chat.id in COMBAT_ROUNDS:
+        await queue_round_attack(message, user_id, npc_id)
+        return
+    # в группе бьём самого раненого, чтобы добивать, а не размазывать урон
+    npc_id = resolve_npc_in_group(npc_id, weakest=True) or npc_id
+    npc = load_npc_full(npc_id)
+    if not npc or not npc["in_combat"]:
+        await message.answer("Моб уже не в бою.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+        COMBAT_SESSIONS.pop(user_id, None)
+        return
+    # compute player's damage
+    char = load_character_full(user_id)
+    if not char:
+        await message.answer("Персонаж не найден.")
+        COMBAT_SESSIONS.pop(user_id, None)
+        return
+    weapon_bonus = int(char.get("weapon_damage") or 0)
+    roll = random.randint(1, 10)
+    total = roll + weapon_bonus
+    res = apply_damage_to_npc(npc_id, total, attacker_id=user_id)
+    log_combat_event("player_attack", user_id, char["username"], npc_id, npc["name"], roll, total,
+                     res["armor"], res["effective"], res["new_hp"], res["was_killed"])
+    msg = f"🎲 d10: {roll} + оружие {weapon_bonus} = {total}\nБроня моба: {res['armor']} -> эффективный урон {res['effective']}. Осталось HP: {res['new_hp']}"
+    if res["was_killed"]:
+        msg += f"\n{npc['name']} погиб."
+        set_npc_in_combat(npc_id, False)
+    COMBAT_SESSIONS.pop(user_id, None)
+    await combat_answer(message, user_id, f"{char['username']} -> {npc['name']}\n{msg}")
+
+async def pick_mob(message: Message, user_id: int, npc_id: int):
+    npc_id = resolve_npc_in_group(npc_id) or npc_id
+    GM_COMBAT_SESSIONS[user_id] = {"step": "admin_npc_actions", "npc_id": npc_id}
+    await message.answer("Действие:",
+                         reply_markup=make_keyboard_from_options(["Испытание", "Урон", "Отмена"], cols=2))
+
+async def pick_npc_target(message: Message, user_id: int, target_id: int):
+    npc_id = GM_COMBAT_SESSIONS[user_id]["npc_id"]
+    if message.chat.id in COMBAT_ROUNDS:
+        await queue_round_npc_attack(message, user_id, npc_id, target_id)
+        return
+    if not load_character_full(target_id):
+        await message.answer("Неверный игрок.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+        GM_COMBAT_SESSIONS.pop(user_id, None)
+        return
+    res = npc_attack_player(npc_id, target_id)
+    target = load_character_full(target_id)
+    npc = load_npc_full(npc_id)
+    log_combat_event("npc_attack", npc_id, npc["name"], target_id, target["username"], res["roll"], res["base_dmg"],
+                     res["armor"], res["effective"], res["new_hp"], res["new_hp"] == 0)
+    GM_COMBAT_SESSIONS.pop(user_id, None)
+    await combat_answer(
+        message, user_id,
+        f"NPC {npc['name']} атаковал {target['username']}: d10 {res['roll']} -> базовый урон {res['base_dmg']}. "
+        f"Броня цели {res['armor']} -> эффективный урон {res['effective']}. HP цели: {res['new_hp']}"
+    )
+
+async def pick_player(message: Message, user_id: int, target_id: int):
+    gs = GM_SESSIONS[user_id]
+    gs["step"] = "chosen_player"
+    gs["target_id"] = target_id
+    # actions
+    await message.answer("Действие для игрока:", reply_markup=make_keyboard_from_options(["Урон","Торговля","Лечение","Здоровье","Отмена"], cols=2))
+
+async def pick_trade_item(message: Message, user_id: int, item_id: int):
+    gs = GM_SESSIONS[user_id]
+    item = get_item_by_id(item_id)
+    active = get_active_store()
+    if not item or not active or item["store_id"] != active["id"]:
+        await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+        GM_SESSIONS.pop(user_id, None)
+        return
+    target_id = gs.get("target_id")
+    # admin buys item for player: check admin gold? we assume admin has infinite funds; per spec we deduct player's gold
+    res = sell_item_to_character(target_id, item)
+    if not res:
+        await message.answer("Игрок не найден.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+        GM_SESSIONS.pop(user_id, None)
+        return
+    char = res["char"]
+    if res["changes"] is None:
+        await message.answer(f"У игрока недостаточно золота ({char.get('gold',0)}g). Товар стоит {item['cost']}g.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+        GM_SESSIONS.pop(user_id, None)
+        return
+    new_gold = res["changes"]["gold"]
+    await message.answer(f"Товар {item['name']} продан игроку {char['username']}. Осталосb золота: {new_gold}", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+    GM_SESSIONS.pop(user_id, None)
+
+PICKER_HANDLERS = {
+    "attack": pick_attack,
+    "mobs": pick_mob,
+    "target": pick_npc_target,
+    "players": pick_player,
+    "trade": pick_trade_item,
+}
+
+def _picker_session(kind: str, user_id: int) -> Optional[Dict[str, Any]]:
+    sessions, step = PICKER_SESSIONS[kind]
+    ses = sessions.get(user_id)
+    return ses if ses and ses.get("step") == step else None
+
+async def picker_search_reply(message: Message, kind: str, query: str):
+    # текст, набранный на шаге пикера, — поисковый запрос ("кол" -> Кольчужная рубаха)
+    rows = await asyncio.to_thread(search_picker, kind, query)  # нечёткий поиск — CPU, не держим event loop
+    if not rows:
+        await message.answer("Ничего не найдено. Уточните запрос или выберите из списка.")
+        return
+    await message.answer(f"Найдено по «{query}»:", reply_markup=make_picker_keyboard(kind, rows, False, False))
+
+@dp.callback_query(F.data.startswith("pg:"))
+async def picker_page_callback(callback: CallbackQuery):
+    try:
+        _, kind, direction, cursor = callback.data.split(":")
+        ses = _picker_session(kind, callback.from_user.id) if kind in PICKERS else None
+        if not ses or not callback.message:
+            await callback.answer("Меню устарело.")
+            return
+        rows, has_prev, has_next = fetch_picker_page(kind, int(cursor), direction)
+        if not rows:
+            await callback.answer("Пусто.")
+            return
+        await callback.message.edit_reply_markup(reply_markup=make_picker_keyboard(kind, rows, has_prev, has_next))
+        await callback.answer()
+    except Exception:
+        logger.exception("Exception in picker_page_callback")
+
+@dp.callback_query(F.data.startswith("pk:"))
+async def picker_pick_callback(callback: CallbackQuery):
+    try:
+        _, kind, value = callback.data.split(":")
+        user_id = callback.from_user.id
+        ses = _picker_session(kind, user_id) if kind in PICKERS else None
+        if not ses or not callback.message:
+            await callback.answer("Меню устарело.")
+            return
+        await callback.answer()
+        await callback.message.edit_reply_markup(reply_markup=None)
+        if value == "cancel":
+            PICKER_SESSIONS[kind][0].pop(user_id, None)
+            await callback.message.answer("Отменено.", reply_markup=main_menu_keyboard(user_id, callback.message.chat.type))
+            return
+        await PICKER_HANDLERS[kind](callback.message, user_id, int(value))
+    except Exception:
+        logger.exception("Exception in picker_pick_callback")
+        try:
+            if callback.message:
+                await callback.message.answer("Внутренняя ошибка. Проверьте логи.")
+        except Exception:
+            logger.exception("Failed to send error message to user")
+
+@dp.callback_query(F.data.startswith("al:"))
+async def allocator_callback(callback: CallbackQuery):
+    try:
+        user_id = callback.from_user.id
+        session = CREATION_SESSIONS.get(user_id)
+        if not session or session.get("step") != "alloc" or not callback.message:
+            await callback.answer("Меню устарело.")
+            return
+        parts = callback.data.split(":")
+        action = parts[1]
+        if action == "noop":
+            await callback.answer()
+            return
+        if action == "ok":
+            if session["remaining"] > 0:
+                await callback.answer(f"Осталось {session['remaining']} очков — потратьте все.", show_alert=True)
+                return
+            await callback.answer()
+            save_character_full(user_id, callback.from_user.username or callback.from_user.full_name,
+                                session["race"], session["class"], dict(session["allocs"]),
+                                inventory=[], weapon=None, armor=None, gold=START_GOLD)
+            CREATION_SESSIONS.pop(user_id, None)
+            attrs_line = ", ".join(f"{a} {v}" for a, v in session["allocs"].items())
+            await callback.message.edit_text(f"{session['race']}, {session['class']}: {attrs_line}")
+            await callback.message.answer("Персонаж сохранён.", reply_markup=main_menu_keyboard(user_id, callback.message.chat.type, has_character=True))
+            return
+        if action == "reset":
+            if session["remaining"] == ALLOC_POINTS:
+                await callback.answer()
+                return
+            session["allocs"] = zero_bonus()
+            session["remaining"] = ALLOC_POINTS
+        else:
+            attr = ATTRIBUTES[int(parts[2])]
+            # нажатия, которые ничего не меняют, не редактируют сообщение (Telegram отверг бы правку)
+            if action == "+" and session["remaining"] > 0:
+                session["allocs"][attr] += 1
+                session["remaining"] -= 1
+            elif action == "-" and session["allocs"][attr] > 0:
+                session["allocs"][attr] -= 1
+                session["remaining"] += 1
+            else:
+                await callback.answer()
+                return
+        await callback.answer()
+        alloc_text, kb = render_allocator(session)
+        await callback.message.edit_text(alloc_text, reply_markup=kb)
+    except Exception:
+        logger.exception("Exception in allocator_callback")
+
+# ====== SCHEDULED JOBS ======
+def regen_hp_tick():
+    # один UPDATE на всех живых раненых; потолок — стартовое HP из save_character_full
+    race_case = "CASE race " + " ".join("WHEN ? THEN ?" for _ in RACE_BONUSES) + " ELSE 0 END"
+    params: List[Any] = [HP_REGEN_AMOUNT]
+    for race, bonuses in RACE_BONUSES.items():
+        params += [race, bonuses["сила"]]
+    max_hp = f"max(10, CAST(round((strength + {race_case}) * 2.2) AS INTEGER))"
+    c = conn()
+    rows = c.execute(f"""
+        UPDATE characters SET hp = min(hp + ?, {max_hp}), version = version + 1
+        WHERE hp > 0 AND hp < {max_hp}
+        RETURNING user_id
+    """, params + params[1:]).fetchall()
+    c.commit()
+    c.close()
+    for (user_id,) in rows:
+        touch_character(user_id)
+    if rows:
+        logger.info("HP regen: %s characters", len(rows))
+
+def encounter_participants(encounter_id: int) -> List[int]:
+    # живые игроки, уже атаковавшие в текущем столкновении
+    flush_combat_events()
+    c = conn()
+    rows = c.execute("""
+        SELECT DISTINCT e.actor_id FROM combat_events e JOIN characters ch ON ch.user_id = e.actor_id
+        WHERE e.encounter_id = ? AND e.kind = 'player_attack' AND ch.hp > 0
+    """, (encounter_id,)).fetchall()
+    c.close()
+    return [r[0] for r in rows]
+
+async def auto_npc_turn(chat_id: int):
+    participants = encounter_participants(current_encounter_id())
+    npcs = [n for n in get_npcs_in_combat() if n["hp"] > 0]
+    if not npcs:
+        cancel_timer(("npc_turns", chat_id))
+        await bot.send_message(chat_id, "Мобов в бою не осталось, автоходы выключены.")
+        return
+    if not participants:
+        return
+    lines = []
+    for npc in npcs:
+        target_id = random.choice(participants)
+        res = npc_attack_player(npc["id"], target_id)
+        target = load_character_full(target_id)
+        log_combat_event("npc_attack", npc["id"], npc["name"], target_id, target["username"], res["roll"], res["base_dmg"],
+                         res["armor"], res["effective"], res["new_hp"], res["new_hp"] == 0)
+        lines.append(f"{npc['name']} -> {target['username']}: d10 {res['roll']}, урон {res['effective']}, HP {res['new_hp']}")
+        if res["new_hp"] == 0:
+            participants.remove(target_id)
+            if not participants:
+                break
+    if chat_id not in COMBAT_PANELS:
+        await bot.send_message(chat_id, "Ход мобов:\n" + "\n".join(lines))
+
+def expire_user_sessions(user_id: int):
+    for sessions in (CREATION_SESSIONS, EQUIP_SESSIONS, GM_SESSIONS, COMBAT_SESSIONS, GM_COMBAT_SESSIONS):
+        sessions.pop(user_id, None)
+    logger.info("Sessions of %s expired", user_id)
+
+@dp.update.outer_middleware()
+async def session_expiry_middleware(handler, event, data):
+    result = await handler(event, data)
+    user = data.get("event_from_user")
+    if user:
+        # таймер держим только пока у пользователя есть незавершённая сессия
+        if any(user.id in s for s in (CREATION_SESSIONS, EQUIP_SESSIONS, GM_SESSIONS, COMBAT_SESSIONS, GM_COMBAT_SESSIONS)):
+            schedule_timer(("session", user.id), SESSION_TTL, expire_user_sessions, user.id)
+        else:
+            cancel_timer(("session", user.id))
+    return result
+
+@dp.message(Command(commands=["autonpc"]))
+async def cmd_autonpc(message: Message):
+    # /autonpc 30 — мобы в бою атакуют участников столкновения каждые 30 с; /autonpc 0 — выключить
+    if message.from_user.id != ADMIN_ID or message.chat.type not in ("group", "supergroup"):
+        await message.answer("Команда доступна администратору в группе.")
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        interval = int(args[0]) if args else 0
+    except ValueError:
+        interval = -1
+    if interval < 0 or 0 < interval < 5:
+        await message.answer("Использование: /autonpc <секунды, от 5> (0 — выключить)")
+        return
+    key = ("npc_turns", message.chat.id)
+    if interval == 0:
+        cancel_timer(key)
+        await message.answer("Автоходы мобов выключены.")
+        return
+    schedule_timer(key, interval, auto_npc_turn, message.chat.id, interval=interval)
+    await message.answer(f"Мобы ходят сами каждые {interval} с.")
+
+# ---------- ROUND MODE ----------
+# /round N: удары игроков и приказы GM мобам копятся N секунд, затем раунд считается целиком —
+# броски пачкой, все HP в памяти, одна транзакция и одно сообщение-итог. Формулы — как в
+# apply_damage_to_npc/npc_attack_player; игроки бьют первыми, погибший за раунд моб не атакует.
+COMBAT_ROUNDS: Dict[int, Dict[str, Any]] = {}  # chat_id -> {"actions": {user_id: группа}, "npc_orders": {npc_id: user_id}, ...}
+ROUND_SUMMARY_LINES = 40
+ROUND_MIN_INTERVAL = 5
+
+async def queue_round_attack(message: Message, user_id: int, npc_id: int):
+    rnd = COMBAT_ROUNDS[message.chat.id]
+    npc = load_npc_full(npc_id)
+    COMBAT_SESSIONS.pop(user_id, None)
+    if not npc:
+        await message.edit_text("Моб уже не в бою.")
+        return
+    group = npc_group(npc["name"])
+    rnd["actions"][user_id] = group  # повторный выбор заменяет прежний
+    await message.edit_text(f"Ход принят: удар по «{group}». Раунд {rnd['number']} скоро завершится.")
+
+async def queue_round_npc_attack(message: Message, user_id: int, npc_id: int, target_id: int):
+    rnd = COMBAT_ROUNDS[message.chat.id]
+    GM_COMBAT_SESSIONS.pop(user_id, None)
+    rnd["npc_orders"][npc_id] = target_id
+    await message.edit_text(f"Приказ принят: моб #{npc_id} атакует игрока {target_id} в раунде {rnd['number']}.")
+
+def resolve_round(actions: Dict[int, str], npc_orders: Dict[int, int]) -> List[str]:
+    c = conn()
+    c.isolation_level = None
+    cur = c.cursor()
+    cur.execute("BEGIN IMMEDIATE")  # чтение и запись раунда без чужих правок между ними
+    try:
+        battle = load_battle()
+        hp = array("l", battle["hp"])
+        index = {npc_id: i for i, npc_id in enumerate(battle["ids"])}
+        user_ids = list(set(actions) | set(npc_orders.values()))
+        players = {}
+        if user_ids:
+            rows = cur.execute(f"""
+                SELECT ch.user_id, ch.username, COALESCE(ch.hp, 0), COALESCE(w.damage, 0), COALESCE(a.armor, 0)
+                FROM characters ch LEFT JOIN items w ON w.id = ch.weapon_id LEFT JOIN items a ON a.id = ch.armor_id
+                WHERE ch.user_id IN ({",".join("?" * len(user_ids))})
+            """, user_ids).fetchall()
+            players = {r[0]: {"name": r[1], "hp": r[2], "start_hp": r[2], "weapon": int(r[3] or 0), "armor": int(r[4] or 0)}
+                       for r in rows}
+        attackers = [uid for uid in actions if uid in players and players[uid]["hp"] > 0]
+        rolls = random.choices(range(1, 11), k=len(attackers) + len(npc_orders))
+        lines, events, stats = [], [], {}
+        for uid, roll in zip(attackers, rolls):
+            p = players[uid]
+            alive = [i for i, g in enumerate(battle["groups"]) if g == actions[uid] and hp[i] > 0]
+            if not alive:
+                lines.append(f"{p['name']}: цель «{actions[uid]}» уже пала")
+                continue
+            i = min(alive, key=lambda j: (hp[j], j))  # как pick_attack — добиваем самого раненого
+            total = roll + p["weapon"]
+            effective = max(0, total - battle["armor"][i])
+            before = hp[i]
+            hp[i] = max(0, before - effective)
+            acc = stats.setdefault(uid, [0, 0])
+            acc[0] += before - hp[i]
+            acc[1] += 1 if hp[i] == 0 else 0
+            events.append(("player_attack", uid, p["name"], battle["ids"][i], battle["names"][i], roll, total,
+                           battle["armor"][i], effective, hp[i], hp[i] == 0))
+            lines.append(f"{p['name']} → {battle['names'][i]}: d10 {roll}+{p['weapon']}, −{effective}, HP {hp[i]}"
+                         + (" ☠" if hp[i] == 0 else ""))
+        for (npc_id, target_id), roll in zip(npc_orders.items(), rolls[len(attackers):]):
+            i = index.get(npc_id)
+            p = players.get(target_id)
+            if i is None or hp[i] == 0 or not p or p["hp"] == 0:
+                continue
+            dmg = roll + battle["damage"][i]
+            effective = max(0, dmg - p["armor"])
+            p["hp"] = max(0, p["hp"] - effective)
+            events.append(("npc_attack", npc_id, battle["names"][i], target_id, p["name"], roll, dmg,
+                           p["armor"], effective, p["hp"], p["hp"] == 0))
+            lines.append(f"{battle['names'][i]} → {p['name']}: d10 {roll}+{battle['damage'][i]}, −{effective}, HP {p['hp']}"
+                         + (" ☠" if p["hp"] == 0 else ""))
+        changed = [i for i in range(len(hp)) if hp[i] != battle["hp"][i]]
+        if changed:
+            persist_npc_hp(cur, [battle["ids"][i] for i in changed], [hp[i] for i in changed])
+        hurt = [(p["hp"], uid) for uid, p in players.items() if p["hp"] != p["start_hp"]]
+        cur.executemany("UPDATE characters SET hp = ?, version = version + 1 WHERE user_id = ?", hurt)
+        for uid, (dealt, kills) in stats.items():
+            bump_stats(cur, uid, damage_dealt=dealt, kills=kills)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        c.close()
+    for _, uid in hurt:
+        touch_character(uid)
+    for ev in events:
+        log_combat_event(*ev)
+    return lines
+
+async def run_combat_round(chat_id: int):
+    rnd = COMBAT_ROUNDS.get(chat_id)
+    if not rnd or not (rnd["actions"] or rnd["npc_orders"]):
+        return
+    actions, npc_orders = rnd["actions"], rnd["npc_orders"]
+    rnd["actions"], rnd["npc_orders"] = {}, {}
+    number = rnd["number"]
+    rnd["number"] += 1
+    lines = resolve_round(actions, npc_orders)
+    shown = lines[:ROUND_SUMMARY_LINES] + ([f"… и ещё {len(lines) - ROUND_SUMMARY_LINES}"] if len(lines) > ROUND_SUMMARY_LINES else [])
+    await bot.send_message(chat_id, f"⚔️ Итоги раунда {number}:\n" + "\n".join(shown))
+
+@dp.message(Command(commands=["round"]))
+async def cmd_round(message: Message):
+    # /round 30 — раунды по 30 с в этой группе; /round 0 — досчитать текущий и вернуться к мгновенным ударам
+    if message.from_user.id != ADMIN_ID or message.chat.type not in ("group", "supergroup"):
+        await message.answer("Команда доступна администратору в группе.")
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        interval = int(args[0]) if args else -1
+    except ValueError:
+        interval = -1
+    if interval < 0 or 0 < interval < ROUND_MIN_INTERVAL:
+        await message.answer(f"Использование: /round <секунды, от {ROUND_MIN_INTERVAL}> (0 — выключить)")
+        return
+    key = ("round", message.chat.id)
+    if interval == 0:
+        cancel_timer(key)
+        await run_combat_round(message.chat.id)
+        COMBAT_ROUNDS.pop(message.chat.id, None)
+        await message.answer("Режим раундов выключен.")
+        return
+    COMBAT_ROUNDS.setdefault(message.chat.id, {"actions": {}, "npc_orders": {}, "number": 1})
+    schedule_timer(key, interval, run_combat_round, message.chat.id, interval=interval)
+    await message.answer(f"Режим раундов: ходы собираются {interval} с, затем считаются разом.")
+
+@dp.message(Command(commands=["flood"]))
+async def cmd_flood(message: Message):
+    # /flood — отброшенные нажатия; /flood <в секунду> <подряд> — новые лимиты для всех действий
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Команда доступна только администратору.")
+        return
+    args = (message.text or "").split()[1:]
+    if args:
+        try:
+            rate, burst = float(args[0]), int(args[1]) if len(args) > 1 else FLOOD_BURST
+        except ValueError:
+            rate, burst = 0, 0
+        if rate <= 0 or burst < 1:
+            await message.answer("Использование: /flood [нажатий в секунду] [нажатий подряд]")
+            return
+        for action in FLOOD_RATES:
+            FLOOD_RATES[action] = (rate, burst)
+        FLOOD_BUCKETS.clear()
+    lines = [f"{a}: {r:g}/с, подряд {b}, отброшено {FLOOD_REJECTED[a]}" for a, (r, b) in FLOOD_RATES.items()]
+    await message.answer("Анти-флуд:\n" + "\n".join(lines))
+
+@dp.message(Command(commands=["profile"]))
+async def cmd_profile(message: Message):
+    # /profile — состояние; /profile slow <мс> | sample <доля> | off | dump | clear
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Команда доступна только администратору.")
+        return
+    args = (message.text or "").split()[1:]
+    sub = args[0].lower() if args else ""
+    try:
+        if sub == "slow":
+            PROFILE_SETTINGS["slow_ms"] = int(args[1]) if len(args) > 1 else PROFILE_SETTINGS["slow_ms"]
+            PROFILE_SETTINGS["mode"] = "slow"
+        elif sub == "sample":
+            rate = float(args[1]) if len(args) > 1 else PROFILE_SETTINGS["rate"]
+            if not 0 < rate <= 1:
+                raise ValueError
+            PROFILE_SETTINGS["rate"], PROFILE_SETTINGS["mode"] = rate, "sample"
+        elif sub == "off":
+            PROFILE_SETTINGS["mode"] = "off"
+        elif sub == "clear":
+            PROFILES.clear()
+        elif sub == "dump":
+            if not PROFILES:
+                await message.answer("Сохранённых профилей нет.")
+                return
+            await message.answer_document(
+                BufferedInputFile(profiles_report().encode("utf-8"), filename=f"profiles-{int(time.time())}.txt"),
+                caption=f"Профили: {len(PROFILES)}, самый медленный {max(PROFILES)[0] * 1000:.0f} мс")
+            return
+        elif sub:
+            raise ValueError
+    except ValueError:
+        await message.answer("Использование: /profile [slow <мс> | sample <доля 0..1> | off | dump | clear]")
+        return
+    mode = PROFILE_SETTINGS["mode"]
+    detail = {"slow": f", порог {PROFILE_SETTINGS['slow_ms']} мс", "sample": f", доля {PROFILE_SETTINGS['rate']:g}"}.get(mode, "")
+    top = ", ".join(f"{route} {elapsed * 1000:.0f} мс" for elapsed, _, route, *_ in sorted(PROFILES, reverse=True)[:5])
+    await message.answer(f"Профилирование: {mode}{detail}. Сохранено {len(PROFILES)}/{PROFILE_KEEP}" + (f"\nСамые медленные: {top}" if top else ""))
+
+@dp.message(Command(commands=["lag"]))
+async def cmd_lag(message: Message):
+    # /lag — задержка event loop (перцентили) и последние остановки с функцией, которая блокировала цикл
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Команда доступна только администратору.")
+        return
+    if not LAG_SAMPLES:
+        await message.answer("Сторож event loop не запущен (LAG_THRESHOLD_MS=0) или ещё нет замеров.")
+        return
+    samples = list(LAG_SAMPLES)
+    lines = [f"Задержка event loop за {len(samples) * LAG_CHECK_INTERVAL / 60:.1f} мин, мс: "
+             + ", ".join(f"p{q} {percentile(samples, q):.1f}" for q in (50, 90, 99)) + f", max {max(samples):.1f}",
+             f"Порог: {LAG_THRESHOLD_MS} мс, остановок: {len(LAG_STALLS)}"]
+    for ts, ms, where, _ in list(LAG_STALLS)[-10:]:
+        lines.append(f"  {time.strftime('%H:%M:%S', time.localtime(ts))} {ms} мс — {where}")
+    await message.answer("\n".join(lines))
+
+# ====== DB MAINTENANCE ======
+# Раз в MAINT_INTERVAL: погибшие мобы (hp=0, вне боя) уходят в npc_archive, старый архив удаляется,
+# а в простое (нет апдейтов MAINT_IDLE_SECONDS) — incremental_vacuum, PRAGMA optimize и checkpoint WAL.
+# Вся работа — в worker-потоке короткими транзакциями, поэтому обработка апдейтов не ждёт.
+MAINT_IDLE_SECONDS = 60
+MAINT_BATCH = 500        # мобов за одну транзакцию
+MAINT_VACUUM_STEP = 256  # страниц за один шаг incremental_vacuum
+MAINT_STATE: Dict[str, Any] = {"running": False, "last_update": 0.0, "last_report": None}
+
+def db_idle() -> bool:
+    return not USER_QUEUES and time.monotonic() - MAINT_STATE["last_update"] >= MAINT_IDLE_SECONDS
+
+def db_size_report() -> Dict[str, int]:
+    c = conn()
+    page_size, pages, free = (c.execute(f"PRAGMA {p}").fetchone()[0] for p in ("page_size", "page_count", "freelist_count"))
+    c.close()
+    return {"bytes": os.path.getsize(DB_PATH), "pages": pages, "free": free, "page_size": page_size}
+
+def archive_dead_npcs_batch() -> int:
+    c = conn()
+    c.isolation_level = None
+    cur = c.cursor()
+    try:
+        cols = ", ".join(col for col in _table_columns(cur, "npc_archive") if col != "archived_at")
+        cur.execute("BEGIN IMMEDIATE")
+        ids = [r[0] for r in cur.execute("SELECT id FROM npc WHERE hp <= 0 AND in_combat = 0 LIMIT ?", (MAINT_BATCH,))]
+        if ids:
+            marks = ",".join("?" * len(ids))
+            cur.execute(f"INSERT OR REPLACE INTO npc_archive ({cols}, archived_at) SELECT {cols}, ? FROM npc WHERE id IN ({marks})",
+                        [int(time.time()), *ids])
+            cur.execute(f"DELETE FROM npc WHERE id IN ({marks})", ids)
+        cur.execute("COMMIT")
+        return len(ids)
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        c.close()
+
+def purge_npc_archive_batch() -> int:
+    c = conn()
+    cur = c.execute("DELETE FROM npc_archive WHERE id IN (SELECT id FROM npc_archive WHERE archived_at < ? LIMIT ?)",
+                    (int(time.time()) - NPC_ARCHIVE_DAYS * 86400, MAINT_BATCH))
+    c.commit()
+    c.close()
+    return cur.rowcount
+
+def incremental_vacuum_enabled() -> bool:
+    c = conn()
+    mode = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+    c.close()
+    return mode == 2
+
+def enable_incremental_vacuum() -> bool:
+    # режим auto_vacuum меняется только полным VACUUM — один раз на базу, дальше шаги incremental_vacuum.
+    # VACUUM держит эксклюзивную блокировку на всё время, поэтому вызывается только в простое.
+    c = conn()
+    try:
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+        return True
+    finally:
+        c.close()
+
+def incremental_vacuum_step() -> int:
+    c = conn()
+    c.execute(f"PRAGMA incremental_vacuum({MAINT_VACUUM_STEP})").fetchall()  # прагма работает, пока читаются строки
+    free = c.execute("PRAGMA freelist_count").fetchone()[0]
+    c.close()
+    return free
+
+def optimize_db() -> List[str]:
+    c = conn()
+    c.execute("PRAGMA analysis_limit = 400")
+    c.execute("PRAGMA optimize")
+    done = ["optimize"]
+    if c.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        done.append("wal_checkpoint")
+    c.close()
+    return done
+
+def format_maintenance(report: Dict[str, Any]) -> str:
+    b, a = report["before"], report["after"]
+    return (f"БД: {b['bytes'] / 1024:.0f} КБ, страниц {b['pages']} (свободных {b['free']}) -> "
+            f"{a['bytes'] / 1024:.0f} КБ, страниц {a['pages']} (свободных {a['free']})\n"
+            f"Мобов в архив: {report['archived']}, удалено из архива: {report['purged']}\n"
+            f"Выполнено: {', '.join(report['steps']) or 'только архив (бот не простаивал)'}; {report['seconds']:.1f} с")
+
+async def run_db_maintenance(force: bool = False) -> Optional[Dict[str, Any]]:
+    if MAINT_STATE["running"]:
+        return None
+    MAINT_STATE["running"] = True
+    start = time.monotonic()
+    try:
+        before = await asyncio.to_thread(db_size_report)
+        archived = purged = 0
+        while n := await asyncio.to_thread(archive_dead_npcs_batch):
+            archived += n
+        while n := await asyncio.to_thread(purge_npc_archive_batch):
+            purged += n
+        steps = []
+        if force or db_idle():
+            enabled = await asyncio.to_thread(incremental_vacuum_enabled)
+            if not enabled and db_idle():
+                # полный VACUUM — только в настоящем простое, даже из /maintenance: обработчики ходят
+                # в SQLite синхронно из event loop и ждали бы его блокировку
+                enabled = await asyncio.to_thread(enable_incremental_vacuum)
+                steps.append("VACUUM (auto_vacuum=INCREMENTAL)")
+            if enabled:
+                free = None
+                while force or db_idle():
+                    left = await asyncio.to_thread(incremental_vacuum_step)
+                    if not left or left == free:
+                        break
+                    free = left
+                steps.append("incremental_vacuum")
+            else:
+                steps.append("VACUUM отложен до простоя")
+            steps += await asyncio.to_thread(optimize_db)
+        report = {"before": before, "after": await asyncio.to_thread(db_size_report), "archived": archived,
+                  "purged": purged, "steps": steps, "seconds": time.monotonic() - start, "at": int(time.time())}
+        MAINT_STATE["last_report"] = report
+        logger.info("DB maintenance: %s", format_maintenance(report).replace("\n", "; "))
+        return report
+    finally:
+        MAINT_STATE["running"] = False
+
+@dp.message(Command(commands=["maintenance"]))
+async def cmd_maintenance(message: Message):
+    # /maintenance — обслуживание БД сейчас, не дожидаясь простоя
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Команда доступна только администратору.")
+        return
+    try:
+        report = await run_db_maintenance(force=True)
+    except Exception as e:
+        logger.exception("DB maintenance failed")
+        await message.answer(f"Ошибка обслуживания БД: {e}")
+        return
+    if report is None:
+        await message.answer("Обслуживание БД уже идёт.")
+        return
+    await message.answer(format_maintenance(report))
+
+# ====== BACKUPS ======
+# Горячая копия dnd.db через sqlite3 backup API: по BACKUP_PAGES_PER_STEP страниц с паузой между шагами,
+# в worker-потоке, так что обработчики успевают писать в базу. Если базу меняют во время копирования,
+# SQLite сам начинает копию заново — результат всегда согласован. Копия проверяется quick_check,
+# сжимается gzip, старые копии сверх BACKUP_KEEP удаляются.
+BACKUP_PAGES_PER_STEP = 128
+BACKUP_STEP_PAUSE = 0.01
+BACKUP_SEND_LIMIT = 49 * 1024 * 1024  # лимит документа Telegram для бота — 50 МБ
+BACKUP_STATE: Dict[str, Any] = {"running": False, "last": None}
+
+def list_backups(dest_dir: str = None) -> List[Path]:
+    return sorted(Path(dest_dir or BACKUP_DIR).glob("dnd-*.db.gz"))
+
+def backup_database(dest_dir: str = None) -> Dict[str, Any]:
+    dest = Path(dest_dir or BACKUP_DIR)
+    dest.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+    name = f"dnd-{time.strftime('%Y%m%d-%H%M%S')}.db"
+    raw, gz = dest / f"{name}.part", dest / f"{name}.gz"
+    src, dst = sqlite3.connect(DB_PATH), sqlite3.connect(raw)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_PAUSE)
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        pages = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    try:
+        if check != "ok":
+            raise RuntimeError(f"backup quick_check failed: {check}")
+        raw_size = raw.stat().st_size
+        with open(raw, "rb") as f, gzip.open(f"{gz}.part", "wb", compresslevel=6) as out:
+            shutil.copyfileobj(f, out)
+        os.replace(f"{gz}.part", gz)
+    finally:
+        raw.unlink(missing_ok=True)
+        Path(f"{gz}.part").unlink(missing_ok=True)
+    removed = 0
+    for old in list_backups(dest)[:-BACKUP_KEEP]:
+        old.unlink()
+        removed += 1
+    return {"path": gz, "pages": pages, "raw_bytes": raw_size, "bytes": gz.stat().st_size,
+            "removed": removed, "seconds": time.monotonic() - start}
+
+def format_backup(res: Dict[str, Any]) -> str:
+    return (f"Резервная копия {res['path'].name}: {res['pages']} страниц, {res['raw_bytes'] / 1024:.0f} КБ -> "
+            f"{res['bytes'] / 1024:.0f} КБ gzip за {res['seconds']:.1f} с. Удалено старых: {res['removed']}")
+
+async def run_backup() -> Optional[Dict[str, Any]]:
+    if BACKUP_STATE["running"]:
+        return None
+    BACKUP_STATE["running"] = True
+    try:
+        res = await asyncio.to_thread(backup_database)
+        BACKUP_STATE["last"] = res
+        logger.info(format_backup(res))
+        return res
+    finally:
+        BACKUP_STATE["running"] = False
+
+@dp.message(Command(commands=["backup"]))
+async def cmd_backup(message: Message):
+    # /backup — сделать копию сейчас; /backup list — список копий; /backup send — прислать последнюю (только в личке)
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Команда доступна только администратору.")
+        return
+    args = (message.text or "").split()[1:]
+    sub = args[0].lower() if args else ""
+    if sub == "list":
+        files = list_backups()
+        lines = [f"  {p.name} — {p.stat().st_size / 1024:.0f} КБ" for p in reversed(files)]
+        await message.answer(f"Резервные копии ({len(files)}/{BACKUP_KEEP}) в {BACKUP_DIR}:\n" + ("\n".join(lines) or "  -"))
+        return
+    if sub == "send":
+        files = list_backups()
+        if message.chat.type != "private":
+            await message.answer("Копию можно получить только в личке.")
+            return
+        if not files:
+            await message.answer("Копий нет.")
+            return
+        if files[-1].stat().st_size > BACKUP_SEND_LIMIT:
+            await message.answer(f"{files[-1].name} больше 50 МБ — заберите с сервера.")
+            return
+        await message.answer_document(FSInputFile(files[-1]), caption=files[-1].name)
+        return
+    if sub:
+        await message.answer("Использование: /backup [list | send]")
+        return
+    try:
+        res = await run_backup()
+    except Exception as e:
+        logger.exception("Backup failed")
+        await message.answer(f"Ошибка резервного копирования: {e}")
+        return
+    await message.answer(format_backup(res) if res else "Резервное копирование уже идёт.")
+
+# ====== UNIVERSAL HANDLER (creation, equip, equip choose_item, GM flows, etc.) ======
 @dp.message()
 async def universal_handler(message: Message):
     try:
@@ -731,44 +3255,19 @@ async def universal_handler(message: Message):
         user_id = message.from_user.id
         text = (message.text or "").strip()
 
+        if message.document and message.chat.type == "private" and user_id == ADMIN_ID:
+            await handle_catalog_upload(message)
+            return
+
+        # выбор из inline-пикера приходит callback'ом; текст на этом шаге — отмена выбора
         if user_id in COMBAT_SESSIONS and COMBAT_SESSIONS[user_id].get("step") == "player_choose_npc":
-            sel = text
-            m = COMBAT_SESSIONS[user_id]["npcs"]
-            if sel not in m:
-                await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
-                COMBAT_SESSIONS.pop(user_id, None);
-                return
-            npc_id = m[sel]
-            # compute player's damage
-            char = load_character_full(user_id)
-            if not char:
-                await message.answer("Персонаж не найден.")
-                COMBAT_SESSIONS.pop(user_id, None);
-                return
-            weapon_bonus = int(char.get("weapon_damage") or 0)
-            roll = random.randint(1, 10)
-            total = roll + weapon_bonus
-            res = apply_damage_to_npc(npc_id, total)
-            msg = f"🎲 d10: {roll} + оружие {weapon_bonus} = {total}\nБроня моба: {res['armor']} -> эффективный урон {res['effective']}. Осталось HP: {res['new_hp']}"
-            if res["was_killed"]:
-                msg += f"\n{sel} погиб."
-                set_npc_in_combat(npc_id, False)
-            await message.answer(msg, reply_markup=main_menu_keyboard(user_id, message.chat.type))
-            COMBAT_SESSIONS.pop(user_id, None)
+            await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+            COMBAT_SESSIONS.pop(user_id, None);
             return
 
         if user_id in GM_COMBAT_SESSIONS and GM_COMBAT_SESSIONS[user_id].get("step") == "admin_choose_npc":
-            logger.info("STADIA %S",GM_COMBAT_SESSIONS[user_id].get("step"))
-            sel = text
-            mp = GM_COMBAT_SESSIONS[user_id]["map"]
-            if sel not in mp:
-                await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
-                GM_COMBAT_SESSIONS.pop(user_id, None);
-                return
-            npc_id = mp[sel]
-            GM_COMBAT_SESSIONS[user_id] = {"step": "admin_npc_actions", "npc_id": npc_id}
-            await message.answer("Действие:",
-                           reply_markup=make_keyboard_from_options(["Испытание", "Урон", "Отмена"], cols=2))
+            await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(user_id, message.chat.type))
+            GM_COMBAT_SESSIONS.pop(user_id, None);
             return
 
         if user_id in GM_COMBAT_SESSIONS and GM_COMBAT_SESSIONS[user_id].get("step") == "admin_npc_actions":
@@ -792,16 +3291,14 @@ async def universal_handler(message: Message):
                 return
             if action == "Урон":
                 # показ игроков-целей
-                players = load_all_characters()
-                if not players:
+                rows, has_prev, has_next = fetch_picker_page("target")
+                if not rows:
                     await message.answer("Нет игроков.", reply_markup=main_menu_keyboard(user_id, message.chat.type));
                     GM_COMBAT_SESSIONS.pop(user_id, None);
                     return
-                labels = [f"{p['username']} ({p['user_id']})" for p in players]
                 GM_COMBAT_SESSIONS[user_id]["step"] = "admin_npc_choose_player"
                 GM_COMBAT_SESSIONS[user_id]["npc_id"] = npc_id
-                GM_COMBAT_SESSIONS[user_id]["players_map"] = {labels[i]: players[i]["user_id"] for i in range(len(players))}
-                await message.answer("Выберите игрока для атаки:", reply_markup=make_keyboard_from_options(labels, cols=2))
+                await message.answer("Выберите игрока для атаки или введите часть имени:", reply_markup=make_picker_keyboard("target", rows, has_prev, has_next))
                 return
 
         if user_id in GM_COMBAT_SESSIONS and GM_COMBAT_SESSIONS[user_id].get("step") == "admin_npc_choose_attr":
@@ -833,23 +3330,7 @@ async def universal_handler(message: Message):
             return
 
         if user_id in GM_COMBAT_SESSIONS and GM_COMBAT_SESSIONS[user_id].get("step") == "admin_npc_choose_player":
-            sel = text
-            pm = GM_COMBAT_SESSIONS[user_id].get("players_map", {})
-            if sel not in pm:
-                await message.answer("Неверный игрок.", reply_markup=main_menu_keyboard(user_id, message.chat.type));
-                GM_COMBAT_SESSIONS.pop(user_id, None);
-                return
-            target_id = pm[sel]
-            npc_id = GM_COMBAT_SESSIONS[user_id]["npc_id"]
-            res = npc_attack_player(npc_id, target_id)
-            target = load_character_full(target_id)
-            npc = load_npc_full(npc_id)
-            await message.answer(
-                f"NPC {npc['name']} атаковал {target['username']}: d10 {res['roll']} -> базовый урон {res['base_dmg']}. "
-                f"Броня цели {res['armor']} -> эффективный урон {res['effective']}. HP цели: {res['new_hp']}",
-                reply_markup=main_menu_keyboard(user_id, message.chat.type)
-            )
-            GM_COMBAT_SESSIONS.pop(user_id, None)
+            await picker_search_reply(message, "target", text)
             return
 
         if message.chat.type == "private" and user_id == ADMIN_ID and text.startswith("Показ магазина:"):
@@ -890,6 +3371,11 @@ async def universal_handler(message: Message):
                 armor_bonus = int(armor.get("bonus").get(text,0))
             roll = random.randint(1, 20)
             total = roll + base + race_bonus + weapon_bonus + armor_bonus
+            if total >= CHECK_DC:
+                c = conn()
+                bump_stats(c.cursor(), user_id, checks_passed=1)
+                c.commit()
+                c.close()
             await message.answer(
                 f"🎲 {message.from_user.first_name} бросок d20: {roll}\n"
                 f"Атрибут {text}: {base} (бонус {race_bonus:+d})\n"
@@ -898,18 +3384,12 @@ async def universal_handler(message: Message):
             return
 
         if text == "Мобы" and message.chat.type in ("group", "supergroup") and user_id == ADMIN_ID:
-            c = conn();
-            cur = c.cursor()
-            cur.execute("SELECT id, name FROM npc where in_combat = 1 ")
-            rows = cur.fetchall();
-            c.close()
+            rows, has_prev, has_next = fetch_picker_page("mobs")
             if not rows:
                 await message.answer("Мобов нет.", reply_markup=main_menu_keyboard(user_id, message.chat.type));
                 return
-            labels = [r[1] for r in rows]
-            GM_COMBAT_SESSIONS[user_id] = {"step": "admin_choose_npc", "map": {r[1]: r[0] for r in rows}}
-            logger.info("STADIA %S",GM_COMBAT_SESSIONS[user_id].get("step"))
-            await message.answer("Выберите моба:", reply_markup=make_keyboard_from_options(labels, cols=2))
+            GM_COMBAT_SESSIONS[user_id] = {"step": "admin_choose_npc"}
+            await message.answer("Выберите моба:", reply_markup=make_picker_keyboard("mobs", rows, has_prev, has_next))
             return
 
         if text == "Создать персонажа":
@@ -955,64 +3435,22 @@ async def universal_handler(message: Message):
                     return
                 session["race"] = selected_key
                 session["step"] = "class"
-                await message.answer("Выберите класс:", reply_markup=make_keyboard_from_options(["воин","вор","волшебник","лучник"], cols=2))
+                await message.answer("Выберите класс:", reply_markup=make_keyboard_from_options(CLASSES, cols=2))
                 return
             if step == "class":
-                if text.lower() not in ("воин","вор","волшебник","лучник"):
-                    await message.answer("Неверный класс. Выберите из кнопок.", reply_markup=make_keyboard_from_options(["воин","вор","волшебник","лучник"], cols=2))
+                if text.lower() not in CLASSES:
+                    await message.answer("Неверный класс. Выберите из кнопок.", reply_markup=make_keyboard_from_options(CLASSES, cols=2))
                     return
                 session["class"] = text.lower()
                 session["step"] = "alloc"
-                session["attrs_list"] = ATTRIBUTES.copy()
-                session["index"] = 0
-                session["remaining"] = 10
-                session["allocs"] = {}
-
-                attrs_display = "\n".join([f"- {i + 1}. {attr}" for i, attr in enumerate(session["attrs_list"])])
-                await message.answer(
-                    "Сейчас вы будете распределять 10 очков между атрибутами.\n\n"
-                    "Атрибуты:\n"
-                    f"{attrs_display}\n\n"
-                    "Важно: потратить нужно все 10 очков. Если останутся — начнём заново."# опционально: можно убрать клавиатуру здесь
-                )
-
-                current_attr = session["attrs_list"][0]
-                await message.answer(f"Осталось {session['remaining']} очков. Сколько в {current_attr}?", reply_markup=make_keyboard_numbers(session["remaining"], 0))
+                session["remaining"] = ALLOC_POINTS
+                session["allocs"] = zero_bonus()
+                # дальше всё распределение — правки этого сообщения (allocator_callback)
+                alloc_text, kb = render_allocator(session)
+                await message.answer(alloc_text, reply_markup=kb)
                 return
             if step == "alloc":
-                try:
-                    val = int(text)
-                except ValueError:
-                    current_attr = session["attrs_list"][session["index"]]
-                    await message.answer(f"Выберите число кнопкой. Сколько в {current_attr}?", reply_markup=make_keyboard_numbers(session["remaining"], 0))
-                    return
-                if val < 0 or val > session["remaining"]:
-                    current_attr = session["attrs_list"][session["index"]]
-                    await message.answer(f"Неверно. Выберите 0..{session['remaining']} для {current_attr}.", reply_markup=make_keyboard_numbers(session["remaining"], 0))
-                    return
-                attr = session["attrs_list"][session["index"]]
-                session["allocs"][attr] = val
-                session["remaining"] -= val
-                session["index"] += 1
-                if session["index"] < len(session["attrs_list"]):
-                    next_attr = session["attrs_list"][session["index"]]
-                    await message.answer(f"Осталось {session['remaining']} очков. Сколько в {next_attr}?", reply_markup=make_keyboard_numbers(session["remaining"], 0))
-                    return
-                if session["remaining"] > 0:
-                    leftover = session["remaining"]
-                    session["allocs"] = {}
-                    session["index"] = 0
-                    session["remaining"] = 10
-                    first_attr = session["attrs_list"][0]
-                    await message.answer(f"Вы не потратили все очки (осталось {leftover}). Начинаем заново. Сколько в {first_attr}?", reply_markup=make_keyboard_numbers(session["remaining"], 0))
-                    return
-                final_attrs = {a: session["allocs"].get(a, 0) for a in ATTRIBUTES}
-                starter_inventory = []
-                save_character_full(user_id, message.from_user.username or message.from_user.full_name,
-                                    session["race"], session["class"], final_attrs,
-                                    inventory=starter_inventory, weapon=None, armor=None, gold=START_GOLD)
-                CREATION_SESSIONS.pop(user_id, None)
-                await message.answer("Персонаж сохранён.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+                await message.answer("Распределите очки кнопками −/+ под сообщением и нажмите «Готово».")
                 return
 
         # EQUIP flow
@@ -1090,49 +3528,17 @@ async def universal_handler(message: Message):
                 chosen_id = ses["candidates_ids"][idx]
 
                 typ = ses["type"]
-                char = load_character_full(user_id)
+                res = equip_item(user_id, chosen_id, typ)
 
-                if not char:
+                if not res:
                     await message.answer("Персонаж не найден.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                     EQUIP_SESSIONS.pop(user_id, None)
                     return
 
-                inventory = char["inventory_ids"][:]  # список ID
-                current_weapon_id = char.get("weapon_id")
-                current_armor_id = char.get("armor_id")
-
-                # 1) Возвращаем старое оружие/броню в инвентарь
-                if typ == "оружие":
-                    if current_weapon_id:
-                        inventory.append(current_weapon_id)
-                else:  # броня
-                    if current_armor_id:
-                        inventory.append(current_armor_id)
-
-                # 2) Убираем выбранный предмет из инвентаря
-                if chosen_id in inventory:
-                    inventory.remove(chosen_id)
-
-                # 3) Обновляем weapon_id / armor_id
-                new_weapon_id = chosen_id if typ == "оружие" else current_weapon_id
-                new_armor_id = chosen_id if typ == "броня" else current_armor_id
-
-                c = conn()
-                cur = c.cursor()
-                cur.execute("""
-                    UPDATE characters SET
-                    weapon_id = ?, armor_id = ?, inventory = ?
-                    WHERE user_id = ?
-                """, (
-                    new_weapon_id,
-                    new_armor_id,
-                    json.dumps(inventory, ensure_ascii=False),
-                    user_id
-                ))
-                c.commit()
-                c.close()
-
                 EQUIP_SESSIONS.pop(user_id, None)
+                if res["changes"] is None:
+                    await message.answer("Этого предмета уже нет в инвентаре.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
+                    return
                 await message.answer(
                     f"{chosen_name} успешно экипирован(а).",
                     reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type)
@@ -1146,19 +3552,13 @@ async def universal_handler(message: Message):
             if text == "Игроки":
                 if message.chat.type != "private":
                     return
-                # list all characters
-                c = conn()
-                cur = c.cursor()
-                cur.execute("SELECT user_id, username FROM characters")
-                rows = cur.fetchall()
-                c.close()
+                # first page of characters, next pages are fetched by callback
+                rows, has_prev, has_next = fetch_picker_page("players")
                 if not rows:
                     await message.answer("Персонажей нет.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                     return
-                names = [f"{r[1]} ({r[0]})" for r in rows]
-                # save mapping
-                GM_SESSIONS[user_id] = {"step": "choose_player", "players_map": {f"{r[1]} ({r[0]})": r[0] for r in rows}}
-                await message.answer("Выберите игрока:", reply_markup=make_keyboard_from_options(names, cols=2))
+                GM_SESSIONS[user_id] = {"step": "choose_player"}
+                await message.answer("Выберите игрока или введите часть имени:", reply_markup=make_picker_keyboard("players", rows, has_prev, has_next))
                 return
             # choose player
             if user_id in GM_SESSIONS:
@@ -1167,17 +3567,7 @@ async def universal_handler(message: Message):
                 if gstep == "choose_player":
                     if message.chat.type != "private":
                         return
-                    sel = text
-                    players_map = gs.get("players_map", {})
-                    if sel not in players_map:
-                        await message.answer("Неверный игрок.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-                        GM_SESSIONS.pop(user_id, None)
-                        return
-                    target_id = players_map[sel]
-                    gs["step"] = "chosen_player"
-                    gs["target_id"] = target_id
-                    # actions
-                    await message.answer("Действие для игрока:", reply_markup=make_keyboard_from_options(["Урон","Торговля","Лечение","Здоровье","Отмена"], cols=2))
+                    await picker_search_reply(message, "players", text)
                     return
                 if gstep == "chosen_player":
                     if message.chat.type != "private":
@@ -1202,16 +3592,8 @@ async def universal_handler(message: Message):
                             await message.answer("Игрок не найден.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                             GM_SESSIONS.pop(user_id, None)
                             return
-                        strength = char["attrs"].get("сила", 0)
-                        race_bonus_strength = int(RACE_BONUSES.get(char.get('race'), {}).get("сила", 0) or 0)
-                        max_hp = round((strength + race_bonus_strength) * 2.2)
-                        if max_hp < 5:
-                            max_hp = 10
-                        c = conn()
-                        cur = c.cursor()
-                        cur.execute("UPDATE characters SET hp = ? WHERE user_id = ?", (max_hp, target_id))
-                        c.commit()
-                        c.close()
+                        max_hp = full_heal_hp(char["attrs"].get("сила", 0), char.get("race"))
+                        update_character_cas(target_id, lambda ch: {"hp": max_hp})
                         await message.answer(f"Игрок {char['username']} вылечен полностью ({max_hp} HP).", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                         GM_SESSIONS.pop(user_id, None)
                         return
@@ -1222,17 +3604,13 @@ async def universal_handler(message: Message):
                             await message.answer("Активный магазин не выбран.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                             GM_SESSIONS.pop(user_id, None)
                             return
-                        items = get_all_items_active_store()
-                        if not items:
+                        rows, has_prev, has_next = fetch_picker_page("trade")
+                        if not rows:
                             await message.answer("В магазине нет предметов.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                             GM_SESSIONS.pop(user_id, None)
                             return
-                        # prepare list and mapping
-                        item_names = [it["name"] + f" ({it['cost']}g)" for it in items]
-                        GS_MAP = {item_names[i]: items[i] for i in range(len(items))}
                         gs["step"] = "gm_trade_choose"
-                        gs["trade_map"] = GS_MAP
-                        await message.answer("Выберите предмет для продажи игроку (админ платит):", reply_markup=make_keyboard_from_options(item_names, cols=2))
+                        await message.answer("Выберите предмет для продажи игроку (админ платит) или введите часть названия:", reply_markup=make_picker_keyboard("trade", rows, has_prev, has_next))
                         return
                 if gstep == "gm_input_damage":
                     if message.chat.type != "private":
@@ -1260,12 +3638,10 @@ async def universal_handler(message: Message):
                             armor_val = int(armor_item.get("armor", 0) or 0)
 
                     effective = max(0, dmg - armor_val)
-                    new_hp = max(0, char.get("hp", 0) - effective)
-                    c = conn()
-                    cur = c.cursor()
-                    cur.execute("UPDATE characters SET hp = ? WHERE user_id = ?", (new_hp, target_id))
-                    c.commit()
-                    c.close()
+                    res = update_character_cas(target_id, lambda ch: {"hp": max(0, ch["hp"] - effective)})
+                    new_hp = res["changes"]["hp"] if res else 0
+                    log_combat_event("gm_damage", user_id, "GM", target_id, char["username"], None, dmg,
+                                     armor_val, effective, new_hp, new_hp == 0)
                     await message.answer(f"Игрок {char['username']} получил {dmg} урона (броня {armor_val} уменьшила урон до {effective}). Текущее HP: {new_hp}", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                     GM_SESSIONS.pop(user_id, None)
                     return
@@ -1286,64 +3662,18 @@ async def universal_handler(message: Message):
                     if not char:
                         await message.answer("Игрок не найден.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                         return
-                    strength = char["attrs"].get("сила",0)
-                    race_bonus_strength = int(RACE_BONUSES.get(char.get('race'), {}).get("сила", 0) or 0)
-                    max_hp = round((strength + race_bonus_strength) * 2.2)
-                    # max_hp = round(char["attrs"].get("сила",0)*2.2)
+                    max_hp = heal_cap(char["attrs"].get("сила",0), char.get("race"))
                     logger.info("heal=%s| Hp=%s",heal,char.get("hp",0))
-                    new_hp = min(max_hp, char.get("hp",0) + heal)
+                    res = update_character_cas(target_id, lambda ch: {"hp": min(max_hp, ch["hp"] + heal)})
+                    new_hp = res["changes"]["hp"] if res else 0
                     logger.info(new_hp)
-                    c = conn()
-                    cur = c.cursor()
-                    cur.execute("UPDATE characters SET hp = ? WHERE user_id = ?", (new_hp, target_id))
-                    c.commit()
-                    c.close()
                     await message.answer(f"Игрок {char['username']} восстановил {heal} HP. Текущее HP: {new_hp}", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
                     GM_SESSIONS.pop(user_id, None)
                     return
                 if gstep == "gm_trade_choose":
                     if message.chat.type != "private":
                         return
-                    sel = text
-                    trade_map = gs.get("trade_map", {})
-                    if sel not in trade_map:
-                        await message.answer("Неверный выбор.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-                        GM_SESSIONS.pop(user_id, None)
-                        return
-                    item = trade_map[sel]
-                    target_id = gs.get("target_id")
-                    char = load_character_full(target_id)
-                    if not char:
-                        await message.answer("Игрок не найден.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-                        GM_SESSIONS.pop(user_id, None)
-                        return
-                    # admin buys item for player: check admin gold? we assume admin has infinite funds; per spec we deduct player's gold
-                    cost = item["cost"]
-                    if char.get("gold",0) < cost:
-                        await message.answer(f"У игрока недостаточно золота ({char.get('gold',0)}g). Товар стоит {cost}g.", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-                        GM_SESSIONS.pop(user_id, None)
-                        return
-                    # deduct gold and add item to inventory
-                    inv_ids = char.get("inventory_ids", [])[:]
-                    inv_ids.append(item["id"])  # добавляем ID предмета
-
-                    new_gold = char.get("gold", 0) - cost
-
-                    c = conn()
-                    cur = c.cursor()
-                    cur.execute("""
-                        UPDATE characters
-                        SET inventory = ?, gold = ?
-                        WHERE user_id = ?
-                    """, (
-                        json.dumps(inv_ids, ensure_ascii=False),
-                        new_gold,
-                        target_id
-                    ))
-                    c.commit()
-                    c.close()
-                    await message.answer(f"Товар {item['name']} продан игроку {char['username']}. Осталосb золота: {new_gold}", reply_markup=main_menu_keyboard(message.from_user.id,message.chat.type))
-                    GM_SESSIONS.pop(user_id, None)
+                    await picker_search_reply(message, "trade", text)
                     return
 
             if text == "Магазины":
@@ -1423,15 +3753,341 @@ async def universal_handler(message: Message):
 #     except Exception:
 #         logger.exception("stores_admin_handler exception")
 
+# ====== FAKE BOT API (нагрузочные тесты) ======
+# Локальная замена api.telegram.org: getUpdates/getMe/sendMessage/editMessageText/answerCallbackQuery,
+# задержка ответа и случайные 429. Генератор нагрузки ведёт виртуальных игроков по сценарию:
+# следующее действие — только после ответа бота (или таймаута), как у живого человека.
+LOADTEST_BASE_UID = 10_000_000
+LOADTEST_SCRIPT = [
+    ("private", "/show"),
+    ("private", "/shop"),
+    ("group", "сила"),
+    ("group", "Урон"),
+    ("callback", "pk:attack:{npc_id}"),
+]
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+def make_fake_api(latency: float = 0.0, flood_rate: float = 0.0):
+    state: Dict[str, Any] = {
+        "updates": [], "new_update": asyncio.Event(), "update_seq": itertools.count(1),
+        "message_seq": itertools.count(1), "waiters": {}, "callbacks": {}, "chat_types": {},
+        "calls": {}, "flood_errors": 0,
+    }
+
+    def reply_to(chat_id):
+        waiter = state["waiters"].pop(chat_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    async def handle(request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        state["calls"][method] = state["calls"].get(method, 0) + 1
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            state["updates"] = [u for u in state["updates"] if u["update_id"] >= offset]
+            if not state["updates"]:
+                state["new_update"].clear()
+                try:
+                    await asyncio.wait_for(state["new_update"].wait(), float(params.get("timeout") or 0))
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({"ok": True, "result": state["updates"][:int(params.get("limit") or 100)]})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "FakeBot",
+                                                             "username": "fake_dnd_bot"}})
+        if latency:
+            await asyncio.sleep(latency)
+        if flood_rate and random.random() < flood_rate:
+            state["flood_errors"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id") or 0)
+            reply_to(chat_id)
+            if method == "editMessageText":
+                return web.json_response({"ok": True, "result": True})
+            return web.json_response({"ok": True, "result": {
+                "message_id": next(state["message_seq"]), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": state["chat_types"].get(chat_id, "private")},
+                "text": params.get("text") or ""}})
+        if method == "answerCallbackQuery":
+            chat_id = state["callbacks"].pop(params.get("callback_query_id"), None)
+            if chat_id is not None:
+                reply_to(chat_id)
+        return web.json_response({"ok": True, "result": True})
+
+    def push_update(user_id: int, kind: str, text: str) -> int:
+        # в «группе» у каждого виртуального игрока свой чат, чтобы ответы не путались
+        chat_id = -user_id if kind in ("group", "callback") else user_id
+        chat_type = "private" if chat_id > 0 else "group"
+        state["chat_types"][chat_id] = chat_type
+        sender = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+        chat = {"id": chat_id, "type": chat_type}
+        update: Dict[str, Any] = {"update_id": next(state["update_seq"])}
+        if kind == "callback":
+            query_id = str(update["update_id"])
+            state["callbacks"][query_id] = chat_id
+            update["callback_query"] = {"id": query_id, "from": sender, "chat_instance": str(chat_id), "data": text,
+                                        "message": {"message_id": 1, "date": int(time.time()), "chat": chat,
+                                                    "text": "..."}}
+        else:
+            update["message"] = {"message_id": next(state["message_seq"]), "date": int(time.time()), "chat": chat,
+                                 "from": sender, "text": text}
+            if text.startswith("/"):
+                update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        state["updates"].append(update)
+        state["new_update"].set()
+        return chat_id
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    state["push_update"] = push_update
+    return app, state
+
+async def start_fake_api(app, host: str, port: int):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def seed_loadtest(users: int) -> int:
+    # виртуальные игроки и один моб в бою; возвращает id моба
+    for i in range(users):
+        uid = LOADTEST_BASE_UID + i
+        if not load_character_full(uid):
+            save_character_full(uid, f"load{uid}", random.choice(list(RACE_BONUSES)), random.choice(CLASSES),
+                                {a: random.randint(0, 3) for a in ATTRIBUTES}, gold=START_GOLD)
+    c = conn()
+    row = c.execute("SELECT id FROM npc WHERE name = 'нагрузочный голем'").fetchone()
+    c.close()
+    npc_id = row[0] if row else create_npc("нагрузочный голем", zero_bonus(), None, None, 10 ** 9, 0, 0)
+    c = conn()
+    c.execute("UPDATE npc SET hp = ?, in_combat = 1 WHERE id = ?", (10 ** 9, npc_id))
+    c.commit()
+    c.close()
+    return npc_id
+
+async def run_load(state, users: int, rounds: int, npc_id: int, reply_timeout: float) -> Dict[str, Any]:
+    latencies: List[float] = []
+    stats = {"sent": 0, "no_reply": 0}
+
+    async def player(user_id: int):
+        for _ in range(rounds):
+            for kind, text in LOADTEST_SCRIPT:
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                started = time.perf_counter()
+                chat_id = state["push_update"](user_id, kind, text.format(npc_id=npc_id))
+                state["waiters"][chat_id] = waiter
+                stats["sent"] += 1
+                try:
+                    latencies.append(await asyncio.wait_for(waiter, reply_timeout) - started)
+                except asyncio.TimeoutError:
+                    state["waiters"].pop(chat_id, None)
+                    stats["no_reply"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(player(LOADTEST_BASE_UID + i) for i in range(users)))
+    stats["elapsed"] = time.perf_counter() - started
+    stats["latencies"] = latencies
+    return stats
+
+async def loadtest(users: int, rounds: int, latency: float, flood_rate: float, reply_timeout: float, port: int):
+    global bot
+    npc_id = seed_loadtest(users)
+    app, state = make_fake_api(latency, flood_rate)
+    runner = await start_fake_api(app, "127.0.0.1", port)
+    bot = make_bot(TOKEN or "123456:LOADTEST", f"http://127.0.0.1:{port}")
+    polling = asyncio.create_task(main())
+    try:
+        stats = await run_load(state, users, rounds, npc_id, reply_timeout)
+        # ждём хвосты: ответ засчитан по первому вызову API, а обработчик ещё может слать сообщения
+        deadline = time.perf_counter() + reply_timeout
+        while USER_QUEUES and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        await dp.stop_polling()
+        await polling
+        await runner.cleanup()
+    lat = [x * 1000 for x in stats["latencies"]]
+    print(f"Апдейтов: {stats['sent']} за {stats['elapsed']:.2f} с ({stats['sent'] / stats['elapsed']:.0f}/с), "
+          f"без ответа: {stats['no_reply']}, 429: {state['flood_errors']}")
+    print(f"Задержка ответа, мс: p50 {percentile(lat, 50):.1f}, p95 {percentile(lat, 95):.1f}, "
+          f"p99 {percentile(lat, 99):.1f}, max {max(lat, default=0):.1f}")
+    print("Вызовы API: " + ", ".join(f"{k} {v}" for k, v in sorted(state["calls"].items())))
+
+async def serve_fake_api(host: str, port: int, latency: float, flood_rate: float):
+    # отдельный сервер: бот запускается рядом с TELEGRAM_API_URL=http://host:port,
+    # апдейты подаются POST /push {"user_id": ..., "kind": "private|group|callback", "text": ...}
+    app, state = make_fake_api(latency, flood_rate)
+
+    async def push(request):
+        body = await request.json()
+        state["push_update"](int(body["user_id"]), body.get("kind", "private"), body["text"])
+        return web.json_response({"ok": True})
+
+    app.router.add_post("/push", push)
+    await start_fake_api(app, host, port)
+    print(f"Fake Bot API: http://{host}:{port}")
+    await asyncio.Event().wait()
+
+# ====== STRESS (CAS) ======
+STRESS_UID = 9_999_999
+
+def cas_stress(ops: int, workers: int) -> bool:
+    """
+    Сотни параллельных продаж и экипировок одному персонажу из пула потоков.
+    Проверяет, что золото и предметы сходятся с успешными операциями, а version выросла ровно на их число.
+    """
+    c = conn()
+    items = [item_from_row(r) for r in
+             c.execute(f"SELECT {ITEM_SQL} FROM items WHERE type IN ('оружие', 'броня') AND cost > 0").fetchall()]
+    c.close()
+    if not items:
+        print("Нет оружия/брони в каталоге.")
+        return False
+    start_gold = sum(it["cost"] for it in items) * ops
+    save_character_full(STRESS_UID, "stress", next(iter(RACE_BONUSES)), CLASSES[0], zero_bonus(), gold=start_gold)
+    start_version = load_character_full(STRESS_UID)["version"]
+    sold: List[Dict[str, Any]] = []
+    equipped: List[int] = []
+
+    def op(i: int):
+        if i % 2 == 0:
+            item = random.choice(items)
+            res = sell_item_to_character(STRESS_UID, item)
+            if res and res["changes"] is not None:
+                sold.append(item)
+            return
+        char = load_character_state(STRESS_UID)
+        if not char["inventory_ids"]:
+            return
+        item = get_item_by_id(random.choice(char["inventory_ids"]))
+        res = equip_item(STRESS_UID, item["id"], item["type"])
+        if res and res["changes"] is not None:
+            equipped.append(item["id"])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(op, range(ops)))
+    elapsed = time.perf_counter() - started
+
+    char = load_character_full(STRESS_UID)
+    owned = Counter(char["inventory_ids"] + [i for i in (char["weapon_id"], char["armor_id"]) if i])
+    checks = {
+        "золото": char["gold"] == start_gold - sum(it["cost"] for it in sold),
+        "предметы": owned == Counter(it["id"] for it in sold),
+        "версия": char["version"] - start_version == len(sold) + len(equipped),
+    }
+    print(f"{ops} операций за {elapsed:.2f} с в {workers} потоках: продаж {len(sold)}, экипировок {len(equipped)}")
+    for name, ok in checks.items():
+        print(f"{name}: {'OK' if ok else 'РАСХОЖДЕНИЕ'}")
+    return all(checks.values())
+
+# ====== CLI ======
+def cli(argv: List[str]) -> int:
+    global DB_PATH
+    parser = argparse.ArgumentParser(prog="main.py", description="Офлайн-команды DnD бота")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_imp = sub.add_parser("import", help="импорт каталога из jsonl/csv")
+    p_imp.add_argument("entity", choices=CATALOG_ENTITIES)
+    p_imp.add_argument("path")
+    p_imp.add_argument("--format", choices=CATALOG_FORMATS)
+    p_exp = sub.add_parser("export", help="выгрузка каталога в jsonl/csv")
+    p_exp.add_argument("entity", choices=CATALOG_ENTITIES)
+    p_exp.add_argument("path")
+    p_exp.add_argument("--format", choices=CATALOG_FORMATS)
+    p_load = sub.add_parser("loadtest", help="прогон main() против локального fake Bot API")
+    p_load.add_argument("--users", type=int, default=50)
+    p_load.add_argument("--rounds", type=int, default=3)
+    p_load.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, с")
+    p_load.add_argument("--flood-rate", type=float, default=0.0, help="доля запросов, получающих 429")
+    p_load.add_argument("--reply-timeout", type=float, default=2.0)
+    p_load.add_argument("--port", type=int, default=8081)
+    p_load.add_argument("--db", default="loadtest.db", help="отдельная БД, чтобы не трогать боевую")
+    p_stress = sub.add_parser("stress", help="параллельные продажи/экипировки одному персонажу (проверка CAS)")
+    p_stress.add_argument("--ops", type=int, default=500)
+    p_stress.add_argument("--workers", type=int, default=16)
+    p_stress.add_argument("--db", default="stress.db")
+    p_sim = sub.add_parser("sim", help="Монте-Карло боёв персонажа против моба/шаблона")
+    p_sim.add_argument("npc", help="id моба или имя шаблона")
+    p_sim.add_argument("--user", type=int, help="персонаж из БД; иначе --hp/--weapon/--armor")
+    p_sim.add_argument("--hp", type=int, default=10)
+    p_sim.add_argument("--weapon", type=int, help="id предмета-оружия")
+    p_sim.add_argument("--armor", type=int, help="id предмета-брони")
+    p_sim.add_argument("--fights", type=int, default=SIM_FIGHTS)
+    p_backup = sub.add_parser("backup", help="горячая резервная копия БД (gzip, с ротацией)")
+    p_backup.add_argument("--dir", default=None, help=f"каталог копий (по умолчанию {BACKUP_DIR})")
+    p_backup.add_argument("--db", default=None, help="какую БД копировать")
+    p_fake = sub.add_parser("fakeapi", help="только fake Bot API сервер")
+    p_fake.add_argument("--host", default="127.0.0.1")
+    p_fake.add_argument("--port", type=int, default=8081)
+    p_fake.add_argument("--latency", type=float, default=0.0)
+    p_fake.add_argument("--flood-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    if args.cmd == "fakeapi":
+        asyncio.run(serve_fake_api(args.host, args.port, args.latency, args.flood_rate))
+        return 0
+    if args.cmd in ("loadtest", "stress"):
+        DB_PATH = args.db
+    if args.cmd == "backup":
+        DB_PATH = args.db or DB_PATH
+        print(format_backup(backup_database(args.dir)))
+        return 0
+    init_db()
+    if args.cmd == "sim":
+        npc = resolve_sim_npc(args.npc)
+        char = load_character_full(args.user) if args.user else None
+        if not npc or (args.user and not char):
+            print("Моб/шаблон или персонаж не найден.")
+            return 1
+        player = sim_player_from_character(char) if char else {
+            "name": "сборка", "hp": args.hp, "weapon_id": args.weapon, "armor_id": args.armor}
+        print(format_simulation(player, npc, simulate_encounter(player, npc, args.fights)))
+        return 0
+    if args.cmd == "stress":
+        return 0 if cas_stress(args.ops, args.workers) else 1
+    if args.cmd == "loadtest":
+        asyncio.run(loadtest(args.users, args.rounds, args.latency, args.flood_rate, args.reply_timeout, args.port))
+        return 0
+    if args.cmd == "import":
+        res = import_catalog(args.entity, args.path, args.format)
+        print(format_import_result(args.entity, res))
+        return 1 if res["error_count"] else 0
+    if args.cmd == "export":
+        count = export_catalog(args.entity, args.path, args.format or catalog_format_from_path(args.path))
+        print(f"{args.entity}: {count} строк -> {args.path}")
+    return 0
+
 # ====== START ======
 async def main():
     init_db()
     logger.info("Bot starting...")
+    scheduler = asyncio.create_task(run_scheduler())
+    if BACKUP_INTERVAL > 0:
+        schedule_timer("backup", BACKUP_INTERVAL, run_backup, interval=BACKUP_INTERVAL)
+    if MAINT_INTERVAL > 0:
+        schedule_timer("db_maintenance", MAINT_INTERVAL, run_db_maintenance, interval=MAINT_INTERVAL)
+    watchdog = asyncio.create_task(loop_lag_monitor()) if LAG_THRESHOLD_MS > 0 else None
+    if HP_REGEN_INTERVAL > 0:
+        schedule_timer("hp_regen", HP_REGEN_INTERVAL, regen_hp_tick, interval=HP_REGEN_INTERVAL)
     try:
         await dp.start_polling(bot)
     finally:
+        scheduler.cancel()
+        if watchdog:
+            watchdog.cancel()
+        flush_combat_events()
         await bot.session.close()
         logger.info("Bot stopped")
 
 if __name__ == "__main__":
+    if CLI_MODE:
+        raise SystemExit(cli(sys.argv[1:]))
     asyncio.run(main())
\ No newline at end of file